@@ -1,5 +1,8 @@
 """Run the project as a module."""
+from multiprocessing import freeze_support
+
 from .cli import main
 
 if __name__ == "__main__":
+    freeze_support()
     main()
@@ -0,0 +1,277 @@
+"""Benchmarks on a synthetic SS14 repository, no checkout needed.
+
+Run with `python -m ss14_tiled.bench --out results.json`, and compare the
+results of two commits to find out if something got slower.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from multiprocessing import freeze_support
+from pathlib import Path
+from typing import Callable
+
+import cv2
+import numpy as np
+import yaml
+
+from .generate import generate
+from .generate.decals import decal_colors
+from .generate.entities import find_entities
+from .generate.inheritance import merge_entity
+from .generate.prototypes import Prototypes, load_yaml
+from .shared import EXECUTORS, Options, add_transparent_image
+
+# Layers that fit together, with the states of every RSI: (name, directions, frames).
+STATES = (("base", 1, 1), ("overlay", 1, 1), ("dir4", 4, 1), ("anim", 4, 3), ("dir8", 8, 1))
+LAYERS = (("base",), ("base", "overlay"), ("dir4", "overlay"), ("anim",), ("dir8",))
+
+
+@dataclass
+class TreeSize:
+    """How much of everything the synthetic repository has."""
+    entities: int = 2000
+    # Number of prototypes from the first base to an entity.
+    depth: int = 4
+    rsis: int = 100
+    tiles: int = 50
+    decals: int = 30
+    palettes: int = 3
+    seed: int = 1
+
+
+def _noise(rng: np.random.Generator, width: int, height: int) -> np.ndarray:
+    """(Internal) A BGRA image with partly transparent noise."""
+    img = rng.integers(0, 256, (height, width, 4), dtype=np.uint8)
+    img[..., 3] = rng.choice(np.array([0, 128, 255], np.uint8), (height, width))
+    return img
+
+
+def _write_rsi(path: Path, rng: np.random.Generator, states: tuple):
+    """(Internal) Write an RSI with the given states, 32x32 each."""
+    path.mkdir(parents=True, exist_ok=True)
+    meta = {"version": 1, "size": {"x": 32, "y": 32}, "states": []}
+    for (name, directions, frames) in states:
+        state = {"name": name}
+        if directions != 1:
+            state["directions"] = directions
+        if frames != 1:
+            state["delays"] = [[0.1] * frames for _ in range(directions)]
+        meta["states"].append(state)
+        cv2.imwrite(str(path / f"{name}.png"), _noise(rng, 32 * directions * frames, 32))
+    (path / "meta.json").write_text(json.dumps(meta), "UTF-8")
+
+
+def _write_prototypes(path: Path, prototypes: list[dict]):
+    """(Internal) Write prototypes as YAML, a few hundred per file like SS14 does."""
+    path.mkdir(parents=True, exist_ok=True)
+    dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+    for i in range(0, len(prototypes), 200):
+        (path / f"bench_{i // 200}.yml").write_text(
+            yaml.dump(prototypes[i:i+200], Dumper=dumper, sort_keys=False), "UTF-8")
+
+
+def make_tree(root: Path, size: TreeSize = None):
+    """Write a synthetic SS14 repository (only the parts this project reads)."""
+    if size is None:
+        size = TreeSize()
+    rng = np.random.default_rng(size.seed)
+    textures = root / "Resources" / "Textures"
+    prototypes = root / "Resources" / "Prototypes"
+
+    for i in range(size.rsis):
+        _write_rsi(textures / "Bench" / f"rsi_{i}.rsi", rng, STATES)
+
+    # Chains of abstract bases, every entity inherits from the end of one (or two).
+    entities = []
+    chains = max(1, size.entities // 50)
+    for chain in range(chains if size.depth > 1 else 0):
+        for level in range(size.depth - 1):
+            base = {"type": "entity", "id": f"BenchBase{chain}_{level}", "abstract": True}
+            if level:
+                base["parent"] = f"BenchBase{chain}_{level - 1}"
+                base["components"] = [{"type": f"BenchComponent{level}", "value": level}]
+            else:
+                base["components"] = [
+                    {"type": "Sprite", "sprite": f"/Textures/Bench/rsi_{chain % size.rsis}.rsi",
+                     "state": "base"},
+                    {"type": "Physics", "bodyType": "Static"}]
+            entities.append(base)
+    for i in range(size.entities):
+        layers = LAYERS[i % len(LAYERS)]
+        entity = {"type": "entity", "id": f"BenchEntity{i}", "name": f"bench entity {i}",
+                  "components": [{"type": "Sprite",
+                                  "sprite": f"/Textures/Bench/rsi_{i % size.rsis}.rsi",
+                                  "layers": [{"state": x} for x in layers]}]}
+        if size.depth > 1:
+            leaf = f"BenchBase{i % chains}_{size.depth - 2}"
+            entity["parent"] = [leaf, f"BenchBase{(i + 1) % chains}_{size.depth - 2}"] \
+                if i % 10 == 9 else leaf
+        # Some are thrown away by the default filters.
+        if i % 25 == 24:
+            entity["suffix"] = "DEBUG"
+        elif i % 30 == 29:
+            entity["categories"] = ["HideSpawnMenu"]
+        entities.append(entity)
+    _write_prototypes(prototypes / "Entities", entities)
+
+    tiles = []
+    (textures / "Tiles").mkdir(parents=True, exist_ok=True)
+    for i in range(size.tiles):
+        variants = 1 + i % 4
+        cv2.imwrite(str(textures / "Tiles" / f"bench_{i}.png"), _noise(rng, 32 * variants, 32))
+        tiles.append({"type": "tile", "id": f"BenchFloor{i}",
+                      "sprite": f"/Textures/Tiles/bench_{i}.png", "variants": variants})
+    _write_prototypes(prototypes / "Tiles", tiles)
+
+    _write_rsi(textures / "Decals" / "bench.rsi", rng,
+               tuple((f"decal_{i}", 1, 1) for i in range(size.decals)))
+    _write_prototypes(prototypes / "Decals", [
+        {"type": "decal", "id": f"BenchDecal{i}",
+         "sprite": {"sprite": "/Textures/Decals/bench.rsi", "state": f"decal_{i}"}}
+        for i in range(size.decals)])
+
+    _write_prototypes(prototypes / "Palettes", [
+        {"type": "palette", "id": f"BenchPalette{i}", "name": f"Bench{i}",
+         "colors": {f"color{j}": "#" + bytes(rng.integers(0, 256, 3, np.uint8)).hex().upper()
+                    for j in range(5)}}
+        for i in range(size.palettes)])
+
+
+def measure(function: Callable, repeat: int) -> dict:
+    """Run a function a few times, the best time is the least disturbed one."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {"best": min(times), "median": statistics.median(times), "repeat": repeat}
+
+
+def run_benchmarks(root: Path, repeat: int = 3, options: Options = None) -> dict[str, dict]:
+    """Run every benchmark on a (synthetic) repository.
+
+    Returns the times in seconds by benchmark, with the number of items each one did.
+    """
+    if options is None:
+        options = Options()
+    results = {}
+
+    def bench(name: str, function: Callable, items: int | Callable[[], int], times: int = repeat):
+        result = measure(function, times)
+        # Some only know how many items they did afterwards.
+        items = items() if callable(items) else items
+        result["items"] = items
+        result["items_per_second"] = items / result["best"] if result["best"] else None
+        results[name] = result
+        print(f"{name:28} {result['best']:9.4f} s {items:8} items")
+
+    files = sorted((root / "Resources" / "Prototypes").glob("**/*.yml"))
+    texts = [x.read_text("UTF-8") for x in files]
+    bench("load_yaml", lambda: [load_yaml(x) for x in texts], len(texts))
+
+    prototypes = Prototypes.from_root(root)
+    entities = prototypes.of_type("entity")
+    bench("find_entities", lambda: find_entities(root, prototypes), len(entities))
+    bench("resolve entities", lambda: find_entities(root, prototypes).resolve_all(),
+          len(entities))
+
+    inheritance = find_entities(root, prototypes)
+    resolved = inheritance.resolve_all()
+    pairs = [(x, resolved[x["parent"][0]]) for x in inheritance.prototypes.values()
+             if x["parent"]]
+    bench("merge_entity", lambda: [merge_entity(*x) for x in pairs], len(pairs))
+
+    rng = np.random.default_rng(1)
+    background, foreground = _noise(rng, 256, 256), _noise(rng, 256, 256)
+    bench("add_transparent_image 256", lambda: [
+        add_transparent_image(background.copy(), foreground) for _ in range(50)], 50)
+    decal = _noise(rng, 32, 32)
+    bench("decal_colors 32", lambda: [decal_colors(decal, "#80C0FF80") for _ in range(1000)],
+          1000)
+
+    def quiet_generate(out: Path, run_options: Options):
+        # Only stdout, the warnings on stderr are worth seeing.
+        with contextlib.redirect_stdout(io.StringIO()):
+            generate(root, output_path=out, options=run_options)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        runs = iter(range(repeat))
+        out = Path(tmp)
+        bench("generate", lambda: quiet_generate(out / str(next(runs)), options),
+              lambda: len(list((out / "0" / ".images").glob("**/*.png"))))
+
+        incremental = Options(**{**asdict(options), "incremental": True})
+        quiet_generate(out / "0", incremental)
+        bench("generate unchanged", lambda: quiet_generate(out / "0", incremental),
+              results["generate"]["items"])
+    return results
+
+
+def _commit() -> str | None:
+    """(Internal) The git commit of this project, if it is a checkout."""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """Entrypoint of `python -m ss14_tiled.bench`."""
+    parser = argparse.ArgumentParser(prog="python3 -m ss14_tiled.bench",
+                                     description="Benchmark on a synthetic SS14 repository.")
+    parser.add_argument("--out", type=Path, metavar="FILE",
+                        help="write the results as JSON to this file")
+    parser.add_argument("--tree", type=Path, metavar="DIR",
+                        help="keep the synthetic repository here (re-used if it exists)")
+    parser.add_argument("--repeat", type=int, default=3, metavar="N",
+                        help="runs of every benchmark, the best counts (default: %(default)s)")
+    parser.add_argument("-j", "--jobs", type=int, metavar="N",
+                        help="number of parallel workers for generate (default: number of CPUs)")
+    parser.add_argument("--executor", choices=EXECUTORS, default="process",
+                        help="how generate runs the workers (default: %(default)s)")
+    defaults = TreeSize()
+    for name in ("entities", "depth", "rsis", "tiles", "decals", "palettes", "seed"):
+        parser.add_argument(f"--{name}", type=int, default=getattr(defaults, name), metavar="N",
+                            help="of the synthetic repository (default: %(default)s)")
+    args = parser.parse_args()
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    size = TreeSize(args.entities, args.depth, args.rsis, args.tiles, args.decals,
+                    args.palettes, args.seed)
+    options = Options(jobs=args.jobs, executor=args.executor)
+    with tempfile.TemporaryDirectory() as tmp:
+        root = args.tree if args.tree is not None else Path(tmp)
+        if not (root / "Resources").exists():
+            start = time.perf_counter()
+            make_tree(root, size)
+            print(f"Synthetic repository written in {time.perf_counter() - start:.1f} s")
+        results = run_benchmarks(root, args.repeat, options)
+
+    report = {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "executor": options.executor,
+        "jobs": options.jobs or os.cpu_count() or 1,
+        "tree": asdict(size),
+        "results": results,
+    }
+    if args.out is not None:
+        args.out.write_text(json.dumps(report, indent=2), "UTF-8")
+        print(f"Results written to '{args.out}'")
+
+
+if __name__ == "__main__":
+    freeze_support()
+    main()
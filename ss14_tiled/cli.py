@@ -1,21 +1,50 @@
 """Everything CLI."""
+import argparse
 import sys
 from pathlib import Path
 
 from .generate import generate
-from .shared import eprint
+from .shared import EXECUTORS, Options
 
 
 def main():
     """Main entrypoint."""
-    if len(sys.argv) != 2:
-        if sys.argv[0].endswith("/ss14-tiled"):
-            eprint("Usage: ss14-tiled </path/to/ss14.git/>")
-        else:
-            eprint("Usage: python3 -m ss14_tiled </path/to/ss14.git/>")
-        sys.exit(1)
+    if sys.argv[0].endswith("/ss14-tiled"):
+        prog = "ss14-tiled"
+    else:
+        prog = "python3 -m ss14_tiled"
 
-    generate(Path(sys.argv[1]).expanduser())
+    parser = argparse.ArgumentParser(prog=prog, description="Create tile-sets for Tiled.")
+    parser.add_argument("root", type=Path, metavar="/path/to/ss14.git/",
+                        help="path to the SS14 repository (or a fork)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only re-create images whose inputs changed since the last run")
+    parser.add_argument("-j", "--jobs", type=int, metavar="N",
+                        help="number of parallel workers (default: number of CPUs)")
+    parser.add_argument("--executor", choices=EXECUTORS, default="process",
+                        help="run the workers as processes, threads or not at all "
+                             "(serial, for profiling) (default: %(default)s)")
+    parser.add_argument("--image-cache-mb", type=int, default=256, metavar="MB",
+                        help="memory for decoded sprites, shared by all workers "
+                             "(default: %(default)s)")
+    parser.add_argument("--rules", type=Path, metavar="FILE",
+                        help="YAML or JSON file to change which entities end up in the tile-sets")
+    parser.add_argument("--atlas", action="store_true",
+                        help="pack the images of each tile-set into a few sprite-sheets "
+                             "(needs Tiled 1.9 or newer)")
+    parser.add_argument("--profile", type=Path, metavar="FILE",
+                        help="write a JSON report with the time and counts of every phase")
+    parser.add_argument("--cprofile", type=Path, metavar="FILE",
+                        help="write cProfile statistics of the main process (for pstats, "
+                             "use with --executor serial to include the workers)")
+    args = parser.parse_args()
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    options = Options(incremental=args.incremental, jobs=args.jobs, executor=args.executor,
+                      image_cache_mb=args.image_cache_mb, rules=args.rules, atlas=args.atlas,
+                      profile=args.profile, cprofile=args.cprofile)
+    generate(args.root.expanduser(), options=options)
 
 
 if __name__ == "__main__":
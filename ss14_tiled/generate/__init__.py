@@ -1,19 +1,34 @@
 """Expose a "generate"-function."""
+import cProfile
+import json
+import os
+import threading
+import time
 from pathlib import Path
 
-from .decals import create_decals
-from .entities import create_entities
-from .tiles import create_tiles
+from ..shared import (IMAGES, PROFILE, Cancelled, Options, init_worker, make_executor,
+                      run_stages)
+from .decals import decal_stages
+from .entities import entity_stages
+from .prototypes import Prototypes
+from .rsi import RSIS
+from .tiles import tile_stages
 
 
-def generate(root: Path, progress_callback=None, output_path=None):
+def generate(root: Path, progress_callback=None, output_path=None, options: Options = None,
+             cancel: threading.Event = None):
     """Create tile-sets for Tiled.
     
     Args:
         root: Path to SS14 repository
         progress_callback: Optional function to call with (current, total) progress updates
         output_path: Optional output directory path (defaults to 'dist')
+        options: Optional settings of this run (see `Options`)
+        cancel: Optional event to stop the run early, which then raises `Cancelled`
+            (the output stays usable, see `run_stages`)
     """
+    if options is None:
+        options = Options()
     if output_path is None:
         out = Path("dist")
     else:
@@ -22,18 +37,80 @@ def generate(root: Path, progress_callback=None, output_path=None):
     (out / ".data").mkdir(exist_ok=True)
     (out / ".images").mkdir(exist_ok=True)
 
-    # Each generation step gets ~33% of the progress
+    # Files may have changed since the last run (of the GUI).
+    RSIS.clear()
+    init_worker(options)
+
+    profiler = None
+    if options.cprofile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        _generate(root, out, options, progress_callback, cancel)
+    finally:
+        seconds = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+            options.cprofile.parent.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(options.cprofile)
+            print(f"cProfile statistics written to '{options.cprofile}'")
+
+    print(f"Image cache: {IMAGES.hits.value} hits, {IMAGES.misses.value} misses")
+    if options.profile is not None:
+        write_profile(options.profile, options, seconds)
+
+
+def _generate(root: Path, out: Path, options: Options, progress_callback=None,
+              cancel: threading.Event = None):
+    """(Internal) All steps of a generate() run."""
+
+    def check():
+        if cancel is not None and cancel.is_set():
+            raise Cancelled()
+
     if progress_callback:
         progress_callback(0, 100)
-    
-    create_decals(root, out)
-    if progress_callback:
-        progress_callback(33, 100)
-    
-    create_entities(root, out)
-    if progress_callback:
-        progress_callback(66, 100)
-    
-    create_tiles(root, out)
+
+    # Parse all prototypes once, every generator reads from this.
+    # Unchanged files are taken from the cache of the previous run.
+    prototypes = Prototypes.from_root(root, out / ".data" / "prototypes.marshal", cancel)
+    # Earlier versions pickled it, which nothing reads anymore.
+    (out / ".data" / "prototypes.pickle").unlink(missing_ok=True)
+
+    # All generators share the same workers, as one stream of jobs:
+    # while one writes its tile-sets, the workers already go on with the next.
+    stages = []
+    with PROFILE.phase("plan"):
+        for plan in (decal_stages, entity_stages, tile_stages):
+            check()
+            stages += plan(root, out, prototypes, options)
+    check()
+    with make_executor(options) as executor:
+        with PROFILE.phase("run"):
+            run_stages(stages, executor, options, progress_callback, cancel=cancel)
     if progress_callback:
         progress_callback(100, 100)
+
+
+def write_profile(path: Path, options: Options, seconds: float):
+    """Write the JSON report of a run with `Options.profile`.
+
+    The time of the phases in the workers is summed up over all of them,
+    so it can be more than the time of the whole run.
+    """
+    PROFILE.count("images: cache hits", IMAGES.hits.value)
+    PROFILE.count("images: cache misses", IMAGES.misses.value)
+    report = {
+        "seconds": round(seconds, 6),
+        "executor": options.executor,
+        "jobs": options.jobs or os.cpu_count() or 1,
+        "incremental": options.incremental,
+        "atlas": options.atlas,
+        **PROFILE.report(),
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(report, indent=2), "UTF-8")
+    print(f"Profile written to '{path}'")
+    for name, phase in list(report["phases"].items())[:10]:
+        print(f"  {phase['seconds']:9.3f} s  {phase['count']:7}x  {name}")
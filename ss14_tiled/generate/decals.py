@@ -1,104 +1,141 @@
 """Everything for the "decal"-tiles."""
-import json
+from concurrent.futures import Executor
+from dataclasses import dataclass
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import cv2
-import yaml
+import numpy as np
 
-from ..shared import CacheJSON, Image, create_tsx, remove_prefix, fix_png_color_profile, eprint
+from ..shared import (IMAGES, PROFILE, Image, Options, Stage, TileCache, create_tsx,
+                      executor_for, file_stamp, hash_inputs, remove_prefix, run_stages, eprint)
+from .prototypes import Prototypes
 
 
-def create_decals(root: Path, out: Path):
+@dataclass
+class DecalSet:
+    """A tile-set of decals, all in the same color."""
+    name: str
+    color: str
+    rgba: tuple[int, int, int, int]
+    existing: TileCache
+
+    @property
+    def dir_name(self) -> str:
+        """Name of the image directory and the tile-set file."""
+        return f"decals_{self.name}" if self.name else "decals"
+
+    @property
+    def title(self) -> str:
+        """Name of the tile-set in Tiled."""
+        return f"Decals - {self.name}" if self.name else "Decals"
+
+
+def create_decals(root: Path, out: Path, prototypes: Prototypes = None, options: Options = None,
+                  executor: Executor = None):
     """Create the "decals"-tiles."""
-    _create_decals(root, out)
-    for (name, color) in get_colors(root):
-        _create_decals(root, out, name, color)
+    if options is None:
+        options = Options()
+    with executor_for(options, executor) as decal_executor:
+        run_stages(decal_stages(root, out, prototypes, options), decal_executor, options)
 
 
-def _create_decals(root: Path, out: Path, name: str = "", color: str = "#FFF"):
-    """(Internal) Create the "decals"-tiles."""
-    dir_name = "decals"
-    title = "Decals"
-    if name:
-        dir_name = f"decals_{name}"
-        title = f"Decals - {name}"
+def decal_stages(root: Path, out: Path, prototypes: Prototypes = None,
+                 options: Options = None) -> list[Stage]:
+    """Plan the "decals"-tiles.
 
-    existing_out = out / ".data" / f"{dir_name}.json"
-    existing = CacheJSON.from_json(existing_out)
+    Every decal sprite is read once, and all palette colors are made from it at once.
+    """
+    if prototypes is None:
+        prototypes = Prototypes.from_root(root)
+    if options is None:
+        options = Options()
 
-    decals_out = out / ".images" / dir_name
-    decals_out.mkdir(parents=True, exist_ok=True)
+    decal_sets: list[DecalSet] = []
+    for (name, color) in [("", "#FFF")] + get_colors(root, prototypes):
+        try:
+            rgba = parse_hex(color)
+        except ValueError:
+            eprint(f"Palette color '{name}' has an unknown format: '{color}'")
+            continue
+        decal_set = DecalSet(name, color, rgba, None)
+        decal_set.existing = TileCache.load(out / ".data" / f"{decal_set.dir_name}.jsonl")
+        (out / ".images" / decal_set.dir_name).mkdir(parents=True, exist_ok=True)
+        decal_sets.append(decal_set)
 
     resources_dir = root / "Resources"
-    yml_dir = resources_dir / "Prototypes/Decals"
-    files = [x for x in yml_dir.glob("**/*.yml") if x.is_file()]
 
-    # Collect all decals to process
+    # Collect all decals to process, with the colors they are missing.
     decals_to_process = []
-    for file in files:
-        try:
-            file_content = file.read_text("UTF-8")
-            # Convert tabs to spaces (YAML doesn't allow tabs)
-            file_content = file_content.replace('\t', '    ')
-            data = yaml.safe_load(file_content)
-        except yaml.YAMLError as e:
-            eprint(f"Error parsing YAML file {file}: {str(e)}")
-            continue
-        
-        if not data:
-            continue
-        
-        for decal in data:
-            if not decal or decal.get("type") != "decal":
-                continue  # alias or null entry?
-            decals_to_process.append((decal, resources_dir, decals_out, color, dir_name))
-
-    # Process decals in parallel
-    def process_decal(args):
-        decal, resources_dir, decals_out, color, dir_name = args
+    targets = []
+    for decal in prototypes.of_type("decal"):
         try:
             sprite: Path = resources_dir / "Textures" / \
                 remove_prefix(decal["sprite"]["sprite"], "/Textures/") / \
                 (str(decal["sprite"]["state"]) + ".png")
-            dest: Path = decals_out / (str(decal["id"]) + sprite.suffix)
-            
-            # Fix PNG color profile issues before processing
-            fix_png_color_profile(sprite)
-            
-            img = cv2.imread(str(sprite), cv2.IMREAD_UNCHANGED)
-            if img is None:
-                eprint(f"Failed to read decal sprite: {sprite}")
-                return None
-            
-            height, width, dim = img.shape
-            if dim == 3:
-                img = cv2.cvtColor(img, cv2.COLOR_RGB2RGBA)
-                dim = 4
-
-            img = decal_colors(img, color)
-            cv2.imwrite(str(dest), img)
-            
-            return (decal["id"], width, height, dir_name, dest.name)
-        except Exception as e:
+        except (KeyError, TypeError) as e:
             eprint(f"Error processing decal {decal.get('id', 'unknown')}: {str(e)}")
+            continue
+
+        stamp = file_stamp(sprite)
+        decal_targets = []
+        for decal_set in decal_sets:
+            dest: Path = out / ".images" / decal_set.dir_name / (str(decal["id"]) + sprite.suffix)
+            inputs = hash_inputs(decal, stamp, decal_set.color)
+            if options.incremental and decal_set.existing.unchanged(decal["id"], inputs, dest):
+                PROFILE.count("decals: unchanged")
+                continue
+            decal_targets.append((decal_set, dest, inputs))
+
+        if decal_targets:
+            decals_to_process.append(
+                (decal, sprite, [(dest, x.rgba) for (x, dest, _) in decal_targets]))
+            targets.append(decal_targets)
+
+    def collect(i: int, result):
+        if not result:
+            return
+        width, height = result
+        decal = decals_to_process[i][0]
+        for decal_set, dest, inputs in targets[i]:
+            decal_set.existing.update(decal["id"], Image(
+                f"./.images/{decal_set.dir_name}/{dest.name}", str(width), str(height)), inputs)
+
+    def finish():
+        for decal_set in decal_sets:
+            decal_set.existing.save()
+            create_tsx(decal_set.existing, decal_set.title, out / f"{decal_set.dir_name}.tsx",
+                       {"color_name": decal_set.name, "color_value": decal_set.color},
+                       options.atlas)
+
+    # Every color of a decal counts as an image of its own.
+    return [Stage(process_decal, decals_to_process, collect, finish, "decals",
+                  [len(x[2]) for x in decals_to_process])]
+
+
+def process_decal(args: tuple):
+    """Color a decal sprite in all the wanted colors and write them.
+
+    Returns the size of the decal.
+    """
+    decal, sprite, targets = args
+    try:
+        img = IMAGES.read(sprite)
+        if img is None:
+            eprint(f"Failed to read decal sprite: {sprite}")
             return None
 
-    # Use ThreadPoolExecutor for parallel processing
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        futures = [executor.submit(process_decal, args) for args in decals_to_process]
-        for future in as_completed(futures):
-            result = future.result()
-            if result:
-                decal_id, width, height, dir_name, dest_name = result
-                if decal_id not in existing.ids:
-                    existing.ids.append(decal_id)
-                    existing.images.append(
-                        Image(f"./.images/{dir_name}/{dest_name}", str(width), str(height)))
+        height, width, _ = img.shape
 
-    existing_out.write_text(json.dumps(existing, default=vars), "UTF-8")
-    create_tsx(existing, title, out /
-               f"{dir_name}.tsx", {"color_name": name, "color_value": color})
+        with PROFILE.phase("decals: tint", len(targets)):
+            variants = tint(img, [rgba for (_, rgba) in targets])
+        for (dest, _), variant in zip(targets, variants):
+            with PROFILE.phase("images: write"):
+                cv2.imwrite(str(dest), variant)
+
+        return (width, height)
+    except Exception as e:
+        eprint(f"Error processing decal {decal.get('id', 'unknown')}: {str(e)}")
+        return None
 
 
 def parse_hex(color: str):
@@ -130,35 +167,36 @@ def parse_hex(color: str):
 
 def decal_colors(img: cv2.Mat, color: str):
     """Scale the colors of an image."""
-    (red, green, blue, alpha) = parse_hex(color)
-    b, g, r, a = cv2.split(img)
-    b = b * (blue / 255)
-    g = g * (green / 255)
-    r = r * (red / 255)
-    a = a * (alpha / 255)
-    return cv2.merge((b, g, r, a))
+    return tint(img, [parse_hex(color)])[0]
+
 
+def tint(img: cv2.Mat, colors: list[tuple[int, int, int, int]]) -> np.ndarray:
+    """Scale the colors of a BGRA image by each of the given RGBA colors.
 
-def get_colors(root: Path) -> list[(str, str)]:
+    All colors are done in one go, the result has the shape (colors, height, width, 4).
+    """
+    factors = np.array([(b, g, r, a) for (r, g, b, a) in colors], np.uint16)
+    scaled = img[np.newaxis].astype(np.uint16) * factors[:, np.newaxis, np.newaxis, :]
+    # Fixed-point for round(scaled / 255), exact for everything up to 255 * 255.
+    scaled += 128
+    scaled += scaled >> 8
+    return (scaled >> 8).astype(np.uint8)
+
+
+def get_colors(root: Path, prototypes: Prototypes = None) -> list[(str, str)]:
     """Get all color names and values (for decals).
 
     Returns [("palette_color", "#value")]
     """
-    resources_dir = root / "Resources"
-    yml_dir = resources_dir / "Prototypes/Palettes"
-    glob = yml_dir.glob("**/*")
-    files = [x for x in glob if x.is_file()]
+    if prototypes is None:
+        prototypes = Prototypes.from_root(root)
 
     results = []
-    for file in files:
-        data = yaml.safe_load(file.read_text("UTF-8"))
-        for palette in data:
-            if palette["type"] != "palette":
-                continue  # alias?
-            for color in palette["colors"]:
-                results.append((
-                    palette["name"] + "_" + color,
-                    palette["colors"][color]
-                ))
+    for palette in prototypes.of_type("palette"):
+        for color in palette["colors"]:
+            results.append((
+                palette["name"] + "_" + color,
+                palette["colors"][color]
+            ))
 
     return results
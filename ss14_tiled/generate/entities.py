@@ -1,405 +1,377 @@
 """Everything for the "entity"-tiles."""
-import copy
-import json
+from concurrent.futures import Executor
+from functools import partial
 from pathlib import Path
 
 import cv2
-import yaml
+import numpy as np
 
-from ..shared import (CacheJSON, Image, add_transparent_image, create_tsx,
-                      eprint, remove_prefix, fix_png_color_profile)
+from ..shared import (IMAGES, PROFILE, Image, Options, Stage, TileCache, add_transparent_image,
+                      create_tsx, eprint, executor_for, file_stamp, hash_inputs, remove_prefix,
+                      run_stages)
+from .inheritance import Inheritance
+from .prototypes import Prototypes
+from .rules import OTHER, FilterRule, GroupRule, Rules, apply_filters
+from .rsi import RSI, RSIS
 
+DIRECTIONS = ("S", "N", "E", "W", "SE", "SW", "NE", "NW")
 
-def create_entities(root: Path, out: Path):
+
+def create_entities(root: Path, out: Path, prototypes: Prototypes = None, options: Options = None,
+                    executor: Executor = None):
     """Create the "entities"-tiles."""
+    if options is None:
+        options = Options()
+    with executor_for(options, executor) as entity_executor:
+        run_stages(entity_stages(root, out, prototypes, options), entity_executor, options)
+
+
+def entity_stages(root: Path, out: Path, prototypes: Prototypes = None,
+                  options: Options = None) -> list[Stage]:
+    """Plan the "entities"-tiles, one stage per group."""
+    if options is None:
+        options = Options()
+
     entities_out = out / ".images" / "entities"
     entities_out.mkdir(parents=True, exist_ok=True)
 
-    entities = find_entities(root)
-    entities = filter_entities(entities)
-    groups = group_entities(entities)
+    rules = Rules.from_file(options.rules)
+    with PROFILE.phase("entities: inheritance graph"):
+        inheritance = find_entities(root, prototypes)
+    entities = select_entities(inheritance, rules.filters)
+    with PROFILE.phase("entities: groups", len(entities)):
+        groups = group_entities(entities, rules.groups)
 
     resources_dir = root / "Resources"
-    for g_name, group in groups:
-        existing_out = out / ".data" / f"entities_{g_name}.json"
-        existing = CacheJSON.from_json(existing_out)
-
-        for entity in sorted(group.values(), key=lambda x: x["id"]):
-            sprite = next(
-                (x for x in entity["components"] if x["type"] == "Sprite"), None)
-            icon = next(
-                (x for x in entity["components"] if x["type"] == "Icon"), None)
-            if not sprite:
-                eprint(f"Entity '{entity['id']}' has no sprite!")
+    # Many entities use the same RSIs.
+    rsi_stamps = {}
+    return [_group_stage(g_name, group, out, resources_dir, options, rsi_stamps)
+            for g_name, group in groups]
+
+
+def _group_stage(g_name: str, group: dict[str, dict], out: Path, resources_dir: Path,
+                 options: Options, rsi_stamps: dict) -> Stage:
+    """Plan the tile-set of a single group of entities."""
+    entities_out = out / ".images" / "entities"
+    existing = TileCache.load(out / ".data" / f"entities_{g_name}.jsonl")
+
+    # Every entity is rendered on its own, so spread them over all workers.
+    jobs = []
+    fingerprints = []
+    for entity in sorted(group.values(), key=lambda x: x["id"]):
+        sprite = next(
+            (x for x in entity["components"] if x["type"] == "Sprite"), None)
+        icon = next(
+            (x for x in entity["components"] if x["type"] == "Icon"), None)
+        if not sprite:
+            eprint(f"Entity '{entity['id']}' has no sprite!")
+            continue
+
+        inputs = entity_inputs(entity, sprite, icon, resources_dir, rsi_stamps)
+        if options.incremental:
+            outputs = [f"{entity['id']}_{x}" for x in DIRECTIONS
+                       if existing.fingerprints.get(f"{entity['id']}_{x}") == inputs]
+            if outputs and all(existing.unchanged(x, inputs, entities_out / f"{x}.png")
+                               for x in outputs):
+                PROFILE.count("entities: unchanged")
                 continue
+        jobs.append(entity)
+        fingerprints.append(inputs)
+
+    # The results come in the (sorted) order, which keeps the tile ids stable.
+    def collect(i: int, outputs: list[tuple[str, Image]]):
+        for tile_id, image in outputs:
+            # Update the sprite but not the index.
+            existing.update(tile_id, image, fingerprints[i])
 
-            max_directions = 1
-            diagonal = "suffix" in entity and "diagonal" in str(entity["suffix"]).lower()
-            if diagonal:
-                max_directions = 4
-            for d, direction in enumerate(("S", "N", "E", "W", "SE", "SW", "NE", "NW")):
-                if d >= max_directions:
-                    break
-
-                dest: Path = entities_out / (str(entity["id"]) + f"_{direction}.png")
-                img = None
-                if "layers" not in sprite:
-                    if "sprite" in sprite and "state" in sprite:
-                        sprite["layers"] = [{
-                            "sprite": sprite["sprite"],
-                            "state": sprite["state"]
-                        }]
-                    elif icon is not None and "sprite" in icon and "state" in icon:
-                        sprite["layers"] = [{
-                            "sprite": icon["sprite"],
-                            "state": icon["state"]
-                        }]
-                    else:
-                        eprint(f"Entity '{entity['id']}' has no sprite!")
-                        continue
-
-                for layer in sprite["layers"]:
-                    # Skip layers that are invisible by default.
-                    if "visible" in layer and not layer["visible"]:
-                        continue
-
-                    if "sprite" not in layer:
-                        if "sprite" in sprite:
-                            layer["sprite"] = sprite["sprite"]
-                        else:
-                            eprint(
-                                f"Entity '{entity['id']}' is missing a sprite!")
-                            continue
-                    if "state" not in layer:
-                        if "map" not in layer and not "type" in layer:
-                            # Simply ignore if the layer uses a map or custom type.
-                            eprint(
-                                f"Entity '{entity['id']}' is missing a state!")
-                        continue
-
-                    layer_rsi_file: Path = resources_dir / "Textures" / \
-                        remove_prefix(layer["sprite"], "/Textures/") / "meta.json"
-                    if not layer_rsi_file.exists():
-                        eprint(f"Entity '{entity['id']}' is missing RSI!")
-                        continue
-
-                    # Some files have a BOM for some reason...
-                    json_text = layer_rsi_file.read_text("UTF-8").replace("\uFEFF", "")
-                    layer_rsa = json.loads(json_text)
-
-                    # YAML has some eager boolean parsing...
-                    if layer["state"] is True:
-                        yes = ["y", "yes", "true", "on"]
-                        state = next(
-                            (x for x in layer_rsa["states"]
-                             if x["name"].lower() in yes), None)
-                    elif layer["state"] is False:
-                        no = ["n", "no", "false", "off"]
-                        state = next(
-                            (x for x in layer_rsa["states"]
-                             if x["name"].lower() in no), None)
-                    else:
-                        state = next(
-                            (x for x in layer_rsa["states"]
-                             if x["name"] == str(layer["state"])), None)
-
-                    if not state:
-                        eprint(f"Entity '{entity['id']}' is missing state '{layer['state']}!")
-                        continue
-
-                    tile_width = layer_rsa["size"]["x"]
-                    tile_height = layer_rsa["size"]["y"]
-
-                    directions = 1
-                    if "directions" in state:
-                        directions = state["directions"]
-                        max_directions = max(max_directions, directions)
-
-                    if directions not in (1, 4, 8):
-                        eprint(f"Entity '{entity['id']} wants {directions} directions!")
-                        continue
-
-                    per_direction = 1
-                    if "delays" in state:
-                        per_direction = len(state["delays"][0])
-
-                    layer_image_file = layer_rsi_file.parent / (state["name"] + ".png")
-                    
-                    # Fix PNG color profile issues before processing
-                    fix_png_color_profile(layer_image_file)
-                    
-                    layer_image = cv2.imread(layer_image_file, cv2.IMREAD_UNCHANGED)
-                    height, width, dim = layer_image.shape
-                    if dim == 3:
-                        layer_image = cv2.cvtColor(layer_image, cv2.COLOR_RGB2RGBA)
-                        dim = 4
-
-                    if directions == 1:
-                        index = 0
-                    elif directions == max_directions:
-                        index = per_direction * d
-                    else:
-                        eprint(f"Entity '{entity['id']} has incompatible directions!")
-                        continue
-
-                    tiles_x = width // tile_width
-                    y_offset = (index // tiles_x) * tile_height
-                    x_offset = (index % tiles_x) * tile_width
-
-                    layer_image = layer_image[
-                        y_offset:y_offset+tile_height,
-                        x_offset:x_offset+tile_width
-                    ]
-                    height, width, dim = layer_image.shape
-
-                    if img is None:
-                        img = layer_image
-                    else:
-                        e_height, e_width, e_dim = img.shape
-                        if e_dim != dim:
-                            eprint(f"Entity '{entity['id']}' has a different number of dimensions!")
-                            continue
-
-                        # Expand canvas so that both are the same size.
-                        # Just center it, as the only entity that uses this is the gravity-gen.
-                        m_height = max(e_height, height)
-                        m_width = max(e_width, width)
-                        
-                        # Calculate padding for img (existing image)
-                        top_pad = (m_height - e_height) // 2
-                        bottom_pad = m_height - e_height - top_pad
-                        left_pad = (m_width - e_width) // 2
-                        right_pad = m_width - e_width - left_pad
-                        
-                        img = cv2.copyMakeBorder(img,
-                                                 top_pad,
-                                                 bottom_pad,
-                                                 left_pad,
-                                                 right_pad,
-                                                 cv2.BORDER_CONSTANT, value=[0, 0, 0, 0])
-                        
-                        # Calculate padding for layer_image (new layer)
-                        top_pad_layer = (m_height - height) // 2
-                        bottom_pad_layer = m_height - height - top_pad_layer
-                        left_pad_layer = (m_width - width) // 2
-                        right_pad_layer = m_width - width - left_pad_layer
-                        
-                        layer_image = cv2.copyMakeBorder(layer_image,
-                                                         top_pad_layer,
-                                                         bottom_pad_layer,
-                                                         left_pad_layer,
-                                                         right_pad_layer,
-                                                         cv2.BORDER_CONSTANT, value=[0, 0, 0, 0])
-                        add_transparent_image(img, layer_image)
-
-                if img is None:
-                    eprint(f"Entity '{entity['id']}' has no valid layers!")
-                    continue
-
-                if diagonal:
-                    if not d:     # S
-                        pass
-                    elif d == 1:  # N
-                        img = cv2.rotate(img, cv2.ROTATE_180)
-                    elif d == 2:  # E
-                        img = cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
-                    elif d == 3:  # W
-                        img = cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
-                    else:
-                        raise ValueError(f"Expected d to be 0-3, not '{d}'.")
-                cv2.imwrite(dest, img)
-
-                # Update the sprite but not the index.
-                if entity["id"] + f"_{directions}" in existing.ids:
-                    continue
-
-                height, width, dim = img.shape
-                existing.ids.append(entity["id"] + f"_{direction}")
-                existing.images.append(
-                    Image(f"./.images/entities/{dest.name}", str(width), str(height)))
-
-        existing_out.write_text(json.dumps(existing, default=vars), "UTF-8")
+    def finish():
+        existing.save()
         create_tsx(existing, f"Entities - {g_name}",
-                   out / f"entities_{g_name}.tsx")
-
-
-def find_entities(root: Path) -> list[dict]:
-    """Find and return all entities."""
-
-    # Some bases are outside the "Entities" directory,
-    # so we have to go over everything.
-    yml_dir = root / "Resources/Prototypes"
-    files = [x for x in yml_dir.glob("**/*.yml") if x.is_file()]
-
-    children = []
-    adults = {}
-    for file in files:
-        try:
-            file_content = file.read_text("UTF-8")
-            # Convert tabs to spaces (YAML doesn't allow tabs)
-            file_content = file_content.replace('\t', '    ')
-            entities_list = yaml.load(file_content, Loader=SafeLoadIgnoreUnknown) or []
-        except yaml.YAMLError as e:
-            eprint(f"Error parsing YAML file {file}: {str(e)}")
+                   out / f"entities_{g_name}.tsx", atlas=options.atlas)
+
+    work = partial(render_entity, resources_dir=resources_dir, entities_out=entities_out)
+    return Stage(work, jobs, collect, finish, f"entities {g_name}")
+
+
+def render_entity(entity: dict, resources_dir: Path, entities_out: Path) -> list[tuple[str, Image]]:
+    """Render and write all directions of an entity.
+
+    Returns the tile ids and images that were written.
+    """
+    sprite = next(
+        (x for x in entity["components"] if x["type"] == "Sprite"), None)
+    icon = next(
+        (x for x in entity["components"] if x["type"] == "Icon"), None)
+
+    outputs = []
+    max_directions = 1
+    diagonal = "suffix" in entity and "diagonal" in str(entity["suffix"]).lower()
+    if diagonal:
+        max_directions = 4
+    # The entity may share its components with others, so don't change them.
+    if "layers" in sprite:
+        layers = sprite["layers"]
+    elif "sprite" in sprite and "state" in sprite:
+        layers = [{
+            "sprite": sprite["sprite"],
+            "state": sprite["state"]
+        }]
+    elif icon is not None and "sprite" in icon and "state" in icon:
+        layers = [{
+            "sprite": icon["sprite"],
+            "state": icon["state"]
+        }]
+    else:
+        eprint(f"Entity '{entity['id']}' has no sprite!")
+        return outputs
+
+    # Look up and read every layer once, the directions are cut out of it below.
+    # (the image, the RSI, the state, the most directions of any layer up to this one)
+    parts = []
+    for layer in layers:
+        # Skip layers that are invisible by default.
+        if "visible" in layer and not layer["visible"]:
             continue
-        
-        for entity in entities_list:
-            if not entity or entity.get("type") != "entity":
-                continue  # alias or null entry?
-            if "parent" in entity:
-                if isinstance(entity["parent"], str):
-                    entity["parent"] = [entity["parent"]]
-                children.append(entity)
-            else:
-                entity["parent"] = []
-                adults[entity["id"]] = entity
-
-    while len(children) > 0:
-        still_children = []
-        for child in children:
-            parents = child["parent"]
-            if isinstance(parents, str):
-                parents = [parents]
-
-            if all(parent in adults for parent in parents):
-                merged = adults[parents[0]]
-                for parent in parents[1:]:
-                    merged = merge_entity(adults[parent], merged)
-                adults[child["id"]] = merge_entity(child, merged)
-            else:
-                still_children.append(child)
 
-        children = still_children
-
-    return adults
+        if "sprite" in layer:
+            layer_sprite = layer["sprite"]
+        elif "sprite" in sprite:
+            layer_sprite = sprite["sprite"]
+        else:
+            eprint(
+                f"Entity '{entity['id']}' is missing a sprite!")
+            continue
+        if "state" not in layer:
+            if "map" not in layer and not "type" in layer:
+                # Simply ignore if the layer uses a map or custom type.
+                eprint(
+                    f"Entity '{entity['id']}' is missing a state!")
+            continue
 
+        rsi = RSIS.get(resources_dir / "Textures" /
+                       remove_prefix(layer_sprite, "/Textures/"))
+        if rsi is None:
+            eprint(f"Entity '{entity['id']}' is missing RSI!")
+            continue
 
-class SafeLoadIgnoreUnknown(yaml.SafeLoader):
-    """YAML-Loader that ignores unknown constructors."""
+        state = rsi.state(layer["state"])
+        if not state:
+            eprint(f"Entity '{entity['id']}' is missing state '{layer['state']}!")
+            continue
 
-    def ignore_unknown(self, _node):
-        """Returns None no matter the node."""
-        return None
+        directions = state.directions
+        max_directions = max(max_directions, directions)
 
+        if directions not in (1, 4, 8):
+            eprint(f"Entity '{entity['id']} wants {directions} directions!")
+            continue
 
-SafeLoadIgnoreUnknown.add_constructor(
-    None, SafeLoadIgnoreUnknown.ignore_unknown)
+        layer_image_file = rsi.path / (state.name + ".png")
 
+        layer_image = IMAGES.read(layer_image_file)
+        if layer_image is None:
+            eprint(f"Entity '{entity['id']}' has an unreadable sprite '{layer_image_file}'!")
+            continue
+        parts.append((layer_image, rsi, state, max_directions))
+
+    # Directions that use the same frames of every layer look the same (before rotating).
+    composed = {}
+    for d, direction in enumerate(DIRECTIONS[:max_directions]):
+        dest: Path = entities_out / (str(entity["id"]) + f"_{direction}.png")
+        frames = []
+        for i, (layer_image, rsi, state, seen_directions) in enumerate(parts):
+            # The first direction only knew about the layers up to this one.
+            if state.directions == 1:
+                frames.append((i, 0))
+            elif state.directions == (seen_directions if not d else max_directions):
+                frames.append((i, state.frames * d))
+            else:
+                eprint(f"Entity '{entity['id']} has incompatible directions!")
 
-def merge_entity(child: dict, parent: dict) -> dict:
-    """Merge entities."""
-    out = copy.deepcopy(parent)
-    for (key, value) in child.items():
-        if key in ("components", "parent"):
+        if not frames:
+            eprint(f"Entity '{entity['id']}' has no valid layers!")
             continue
-        out[key] = value
+        frames = tuple(frames)
+        if frames not in composed:
+            with PROFILE.phase("entities: composite"):
+                composed[frames] = compose_layers([cut_frame(*parts[i][:2], index)
+                                                   for i, index in frames])
+        img = composed[frames]
+
+        if diagonal:
+            if not d:     # S
+                pass
+            elif d == 1:  # N
+                img = cv2.rotate(img, cv2.ROTATE_180)
+            elif d == 2:  # E
+                img = cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
+            elif d == 3:  # W
+                img = cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
+            else:
+                raise ValueError(f"Expected d to be 0-3, not '{d}'.")
+        with PROFILE.phase("images: write"):
+            cv2.imwrite(dest, img)
 
-    if "abstract" in child and child["abstract"]:
-        out["abstract"] = True
-    elif "abstract" in out:
-        del out["abstract"]
+        height, width = img.shape[:2]
+        outputs.append((entity["id"] + f"_{direction}", Image(
+            f"./.images/entities/{dest.name}", str(width), str(height))))
 
-    out["parent"] = list(set(out["parent"] + child["parent"]))
+    return outputs
 
-    if "components" in child:
-        if not "components" in out:
-            out["components"] = child["components"]
-        else:
-            for child_comp in child["components"]:
-                found = False
-                for i, out_comp in enumerate(out["components"]):
-                    if child_comp["type"] != out_comp["type"]:
-                        continue
-                    found = True
-                    for (key, value) in child_comp.items():
-                        out_comp[key] = value
-                    out["components"][i] = out_comp
-                if not found:
-                    out["components"].append(child_comp)
-
-    return out
-
-
-def filter_entities(entities: dict) -> dict:
-    """Filter out some of the entities."""
-    entities = {k: v for k, v in entities.items()
-                if "abstract" not in v}
-    entities = {k: v for k, v in entities.items()
-                if "Sprite" in [x["type"] for x in v["components"]]}
-    entities = {k: v for k, v in entities.items()
-                if "TimedDespawn" not in [x["type"] for x in v["components"]]}
-    entities = {k: v for k, v in entities.items()
-                if "suffix" not in v or "DEBUG" not in str(v["suffix"])}
-    entities = {k: v for k, v in entities.items()
-                if "suffix" not in v or "Admeme" not in str(v["suffix"])}
-    entities = {k: v for k, v in entities.items()
-                if "suffix" not in v or "DO NOT MAP" not in str(v["suffix"])}
-    entities = {k: v for k, v in entities.items()
-                if "categories" not in v or "HideSpawnMenu" not in v["categories"]}
-    entities = {k: v for k, v in entities.items()
-                if "Input" not in [x["type"] for x in v["components"]]}
-    entities = {k: v for k, v in entities.items()
-                if "RandomHumanoidSpawner" not in [x["type"] for x in v["components"]]}
-
-    return entities
-
-
-def group_entities(entities: dict) -> list[tuple[str, dict[str, dict]]]:
-    """Split entities into groups."""
-    pipes = {}
-    window_doors = {}
-    eat_and_drink = {}
-    clothes = {}
-    closets = {}
-    airlocks = {}
-    windows = {}
-    walls = {}
-    computers = {}
-    markers = {}
-    signs = {}
-    other = {}
 
-    for key, value in entities.items():
-        parents = value["parent"]
-        if "GasPipeBase" in parents or "DisposalPipeBase" in parents:
-            pipes[key] = value
-        elif "BaseWindoor" in parents:
-            window_doors[key] = value
-        elif "FoodBase" in parents or "DrinkBase" in parents:
-            eat_and_drink[key] = value
-        elif "Clothing" in parents:
-            clothes[key] = value
-        elif "ClosetBase" in parents or "BaseWallCloset" in parents:
-            closets[key] = value
-        elif key == "Airlock" or "Airlock" in parents or "BaseFirelock" in parents:
-            airlocks[key] = value
-        elif key == "Window" or "Window" in parents \
-                or key == "WindowDirectional" or "WindowDirectional" in parents \
-                or "PlastitaniumWindowBase" in parents:
-            windows[key] = value
-        elif key == "WallShuttleDiagonal" or "WallShuttleDiagonal" in parents \
-                or key == "WallPlastitaniumDiagonalIndestructible" or "BaseWall" in parents:
-            walls[key] = value
-        elif "BaseComputer" in parents:
-            computers[key] = value
-        elif "MarkerBase" in parents:
-            markers[key] = value
-        elif "BaseSign" in parents:
-            signs[key] = value
-        else:
-            other[key] = value
-
-    return [
-        ("Pipes", pipes),
-        ("Windoors", window_doors),
-        ("Eat and Drink", eat_and_drink),
-        ("Clothes", clothes),
-        ("Closets and Lockers", closets),
-        ("Airlocks", airlocks),
-        ("Windows", windows),
-        ("Walls", walls),
-        ("Computers", computers),
-        ("Markers", markers),
-        ("Signs", signs),
-        ("Other", other),
+def cut_frame(layer_image: np.ndarray, rsi: RSI, index: int) -> np.ndarray:
+    """Cut a single frame out of the sprite-sheet of a state."""
+    tiles_x = layer_image.shape[1] // rsi.width
+    y_offset = (index // tiles_x) * rsi.height
+    x_offset = (index % tiles_x) * rsi.width
+    return layer_image[
+        y_offset:y_offset+rsi.height,
+        x_offset:x_offset+rsi.width
     ]
+
+
+def compose_layers(layer_images: list[np.ndarray]) -> np.ndarray:
+    """Draw the layers over each other on one canvas, each centered.
+
+    The canvas is allocated once, with its final size. The layers end up where they did
+    when the canvas was padded for every layer: centered on the layers before them,
+    and every layer fades the canvas outside of it a bit (see `add_transparent_image`).
+    """
+    # Where the layers go, relative to the first one, while the canvas grows.
+    height, width = layer_images[0].shape[:2]
+    top = left = 0
+    positions = []
+    for layer_image in layer_images:
+        l_height, l_width = layer_image.shape[:2]
+        m_height = max(height, l_height)
+        m_width = max(width, l_width)
+        top -= (m_height - height) // 2
+        left -= (m_width - width) // 2
+        height, width = m_height, m_width
+        positions.append((top + (height - l_height) // 2, left + (width - l_width) // 2))
+
+    # The cached images are shared, so only draw on the canvas.
+    img = np.zeros((height, width, 4), np.uint8)
+    for i, (layer_image, (y, x)) in enumerate(zip(layer_images, positions)):
+        l_height, l_width = layer_image.shape[:2]
+        y -= top
+        x -= left
+        if not i:
+            img[y:y+l_height, x:x+l_width] = layer_image
+            continue
+        add_transparent_image(img[y:y+l_height, x:x+l_width], layer_image)
+        # Outside of the layer it is transparent, which only fades the colors.
+        for part in (img[:y], img[y+l_height:], img[y:y+l_height, :x],
+                     img[y:y+l_height, x+l_width:]):
+            if part.size:
+                part[:, :, :3] = part[:, :, :3] * part[:, :, 3:].astype(np.uint32) // 255
+
+    return img
+
+
+def entity_inputs(entity: dict, sprite: dict, icon: dict, resources_dir: Path,
+                  rsi_stamps: dict = None) -> str:
+    """Fingerprint everything the images of an entity are made from.
+
+    `rsi_stamps` keeps the file stamps of RSIs, for the next entities using them.
+    """
+    if rsi_stamps is None:
+        rsi_stamps = {}
+    rsi_paths = set()
+    for component in (sprite, icon or {}):
+        if "sprite" in component:
+            rsi_paths.add(str(component["sprite"]))
+        for layer in component.get("layers") or []:
+            if isinstance(layer, dict) and "sprite" in layer:
+                rsi_paths.add(str(layer["sprite"]))
+
+    rsis = {}
+    for rsi_path in sorted(rsi_paths):
+        if rsi_path not in rsi_stamps:
+            rsi_dir = resources_dir / "Textures" / remove_prefix(rsi_path, "/Textures/")
+            rsi_stamps[rsi_path] = sorted(file_stamp(x) for x in rsi_dir.glob("*")
+                                          if x.suffix in (".png", ".json"))
+        rsis[rsi_path] = rsi_stamps[rsi_path]
+
+    # The parents only decide the group, which has its own cache.
+    return hash_inputs({k: v for k, v in entity.items() if k != "parent"}, rsis)
+
+
+def find_entities(root: Path, prototypes: Prototypes = None) -> Inheritance:
+    """Find all entities, ready to be merged with their parents."""
+    if prototypes is None:
+        # Some bases are outside the "Entities" directory,
+        # so we have to go over everything.
+        prototypes = Prototypes.from_root(root)
+
+    inheritance = Inheritance(prototypes.of_type("entity"))
+    for entity_id, missing in inheritance.missing.items():
+        eprint(f"Entity '{entity_id}' has unknown parents: {', '.join(map(str, missing))}")
+    for cycle in inheritance.cycles:
+        eprint(f"Entities inherit from themselves: {' -> '.join(map(str, cycle + cycle[:1]))}")
+    skipped = inheritance.unresolved - set(inheritance.missing).union(*inheritance.cycles)
+    if skipped:
+        eprint(f"{len(skipped)} more entities are skipped, their parents can't be resolved.")
+
+    return inheritance
+
+
+def entity_header(entity: dict) -> dict:
+    """The entity with only the types of its components, enough for `filter_entities`."""
+    if "components" not in entity:
+        return entity
+    return {**entity, "components": [{"type": x["type"]} for x in entity["components"]]}
+
+
+def select_entities(inheritance: Inheritance, filters: list[FilterRule] = None) \
+        -> dict[str, dict]:
+    """Merge the entities that pass the filters, and only those.
+
+    The filters are decided on the merged headers first, which are cheap,
+    as most entities are thrown away.
+    """
+    with PROFILE.phase("entities: merge headers", len(inheritance.order)):
+        headers = inheritance.view(entity_header).resolve_all()
+    if filters is None:
+        filters = Rules.default().filters
+    with PROFILE.phase("entities: filter", len(headers)):
+        kept, removed = apply_filters(headers, filters)
+    print("Filtered out entities: " + ", ".join(f"{k}: {v}" for k, v in removed.items()))
+    with PROFILE.phase("entities: merge", len(kept)):
+        return {x: inheritance.resolve(x) for x in kept}
+
+
+def filter_entities(entities: dict, filters: list[FilterRule] = None) -> dict:
+    """Filter out some of the entities (see `DEFAULT_RULES`)."""
+    if filters is None:
+        filters = Rules.default().filters
+    return apply_filters(entities, filters)[0]
+
+
+def group_entities(entities: dict, groups: list[GroupRule] = None) \
+        -> list[tuple[str, dict[str, dict]]]:
+    """Split entities into groups.
+
+    An entity goes into the first group that has its id or any of its ancestors,
+    everything else into "Other".
+    """
+    if groups is None:
+        groups = Rules.default().groups
+
+    # Id -> index of the first group that wants it.
+    by_id: dict[str, int] = {}
+    by_ancestor: dict[str, int] = {}
+    for i, group in enumerate(groups):
+        for x in group.ids:
+            by_id.setdefault(x, i)
+        for x in group.ancestors:
+            by_ancestor.setdefault(x, i)
+
+    results = [(x.name, {}) for x in groups] + [(OTHER, {})]
+    for key, value in entities.items():
+        # Merged entities have all of their ancestors as parents.
+        matches = by_ancestor.keys() & value["parent"]
+        i = min([by_ancestor[x] for x in matches] + [by_id.get(key, len(groups))])
+        results[i][1][key] = value
+
+    return results
@@ -0,0 +1,178 @@
+"""Everything for resolving the parents of prototypes."""
+import copy
+from collections import deque
+from typing import Callable, Iterable
+
+
+def merge_entity(child: dict, parent: dict) -> dict:
+    """Merge entities.
+
+    Neither of them is changed, and everything the child doesn't change is shared
+    with the parent instead of copied. So the result must not be changed in place either.
+    """
+    out = dict(parent)
+    for (key, value) in child.items():
+        if key in ("components", "parent"):
+            continue
+        out[key] = value
+
+    if "abstract" in child and child["abstract"]:
+        out["abstract"] = True
+    elif "abstract" in out:
+        del out["abstract"]
+
+    out["parent"] = list(set(out["parent"] + child["parent"]))
+
+    if "components" in child:
+        if not "components" in out:
+            out["components"] = child["components"]
+        else:
+            components = list(out["components"])
+            by_type: dict[str, list[int]] = {}
+            for i, component in enumerate(components):
+                by_type.setdefault(component["type"], []).append(i)
+            for child_comp in child["components"]:
+                if child_comp["type"] in by_type:
+                    # Only the changed components are copied.
+                    for i in by_type[child_comp["type"]]:
+                        components[i] = {**components[i], **child_comp}
+                else:
+                    by_type[child_comp["type"]] = [len(components)]
+                    components.append(child_comp)
+            out["components"] = components
+
+    return out
+
+
+def parents_of(prototype: dict) -> list[str]:
+    """The parents of a prototype, which may be given as a single id or a list."""
+    parents = prototype.get("parent")
+    if parents is None:
+        return []
+    if isinstance(parents, str):
+        return [parents]
+    return list(parents)
+
+
+class Inheritance:
+    """The parent graph of prototypes, resolved in topological order.
+
+    The graph is built once. Every prototype is merged only once, after all of its
+    parents, and the result is kept, so shared bases are never merged again.
+    Prototypes with unknown parents (or with parents that inherit from each other)
+    can't be resolved, they are listed in `missing` and `cycles` instead.
+    """
+
+    def __init__(self, prototypes: Iterable[dict],
+                 merge: Callable[[dict, dict], dict] = merge_entity):
+        self.merge = merge
+        # Id -> the prototype as written, with the parents always as a list.
+        self.prototypes: dict[str, dict] = {}
+        for prototype in prototypes:
+            if "id" not in prototype:
+                continue
+            # Don't change the prototypes themselves, others may use them too.
+            self.prototypes[prototype["id"]] = {**prototype, "parent": parents_of(prototype)}
+
+        # Id -> parents that don't exist.
+        self.missing: dict[str, list[str]] = {}
+        children: dict[str, list[str]] = {}
+        waiting: dict[str, int] = {}
+        for prototype_id, prototype in self.prototypes.items():
+            parents = prototype["parent"]
+            missing = [x for x in parents if x not in self.prototypes]
+            if missing:
+                self.missing[prototype_id] = missing
+            known = set(parents) - set(missing)
+            waiting[prototype_id] = len(known)
+            for parent in known:
+                children.setdefault(parent, []).append(prototype_id)
+
+        # Kahn's algorithm: a prototype is ready once all of its parents are.
+        self.order: list[str] = []
+        ready = deque(x for x, count in waiting.items() if not count and x not in self.missing)
+        while ready:
+            prototype_id = ready.popleft()
+            self.order.append(prototype_id)
+            for child in children.get(prototype_id, []):
+                waiting[child] -= 1
+                if not waiting[child] and child not in self.missing:
+                    ready.append(child)
+
+        self._position = {x: i for i, x in enumerate(self.order)}
+        # Everything that can't be resolved, because of a missing parent or a cycle.
+        self.unresolved: set[str] = set(self.prototypes) - set(self._position)
+        # Each is a list of ids where every one is a parent of the one before.
+        self.cycles: list[list[str]] = self._find_cycles()
+        self._resolved: dict[str, dict] = {}
+
+    def _find_cycles(self) -> list[list[str]]:
+        """Find the cycles among the unresolved prototypes (depth-first, without recursion)."""
+        cycles = []
+        done = set()
+        for start in sorted(self.unresolved):
+            if start in done:
+                continue
+            path = [start]
+            on_path = {start}
+            stack = [iter(self.prototypes[start]["parent"])]
+            while stack:
+                parent = next(stack[-1], None)
+                if parent is None:
+                    done.add(path[-1])
+                    on_path.remove(path.pop())
+                    stack.pop()
+                elif parent in on_path:
+                    cycles.append(path[path.index(parent):])
+                elif parent in self.unresolved and parent not in done:
+                    path.append(parent)
+                    on_path.add(parent)
+                    stack.append(iter(self.prototypes[parent]["parent"]))
+        return cycles
+
+    def resolve(self, prototype_id: str) -> dict | None:
+        """The prototype merged with all of its parents, None if that isn't possible."""
+        if prototype_id in self._resolved:
+            return self._resolved[prototype_id]
+        if prototype_id not in self._position:
+            return None
+
+        # Find the ancestors that aren't resolved yet, and do them parents first.
+        todo = {prototype_id}
+        stack = [prototype_id]
+        while stack:
+            for parent in self.prototypes[stack.pop()]["parent"]:
+                if parent not in todo and parent not in self._resolved:
+                    todo.add(parent)
+                    stack.append(parent)
+        for x in sorted(todo, key=self._position.__getitem__):
+            self._resolved[x] = self._merge(self.prototypes[x])
+        return self._resolved[prototype_id]
+
+    def _merge(self, prototype: dict) -> dict:
+        """Merge a prototype whose parents are all resolved."""
+        parents = prototype["parent"]
+        if not parents:
+            return prototype
+        merged = self._resolved[parents[0]]
+        for parent in parents[1:]:
+            merged = self.merge(self._resolved[parent], merged)
+        return self.merge(prototype, merged)
+
+    def view(self, transform: Callable[[dict], dict]) -> "Inheritance":
+        """The same graph, but every prototype is transformed before it is merged.
+
+        Useful to resolve only some parts of the prototypes, which is a lot cheaper.
+        The transform has to keep the parents.
+        """
+        view = copy.copy(self)
+        view.prototypes = {k: transform(v) for k, v in self.prototypes.items()}
+        view._resolved = {}  # pylint: disable=protected-access
+        return view
+
+    def resolve_all(self) -> dict[str, dict]:
+        """All prototypes that can be resolved, by id."""
+        for prototype_id in self.order:
+            if prototype_id not in self._resolved:
+                self._resolved[prototype_id] = self._merge(self.prototypes[prototype_id])
+        return {x: self._resolved[x] for x in self.order}
@@ -0,0 +1,171 @@
+"""Everything for loading the prototypes of a SS14 repository."""
+import marshal
+import os
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+
+import yaml
+
+from ..shared import PROFILE, Cancelled, eprint
+
+try:
+    from yaml import CSafeLoader
+    HAS_LIBYAML = True
+except ImportError:
+    HAS_LIBYAML = False
+
+
+class SafeLoadIgnoreUnknown(yaml.SafeLoader):
+    """YAML-Loader that ignores unknown constructors."""
+
+    def ignore_unknown(self, _node):
+        """Returns None no matter the node."""
+        return None
+
+
+SafeLoadIgnoreUnknown.add_constructor(
+    None, SafeLoadIgnoreUnknown.ignore_unknown)
+
+if HAS_LIBYAML:
+    class CSafeLoadIgnoreUnknown(CSafeLoader):
+        """Same as `SafeLoadIgnoreUnknown`, but backed by libyaml."""
+
+        def ignore_unknown(self, _node):
+            """Returns None no matter the node."""
+            return None
+
+    CSafeLoadIgnoreUnknown.add_constructor(
+        None, CSafeLoadIgnoreUnknown.ignore_unknown)
+
+    # Much faster, so prefer it whenever PyYAML was built with libyaml.
+    FastLoader = CSafeLoadIgnoreUnknown
+else:
+    FastLoader = SafeLoadIgnoreUnknown
+
+
+# Bump this whenever the cached representation of a file changes.
+CACHE_VERSION = 2
+
+
+def load_yaml(text: str, loader: type = FastLoader) -> list:
+    """Parse the content of a prototype file."""
+    # Convert tabs to spaces (YAML doesn't allow tabs)
+    text = text.replace('\t', '    ')
+    return yaml.load(text, Loader=loader) or []
+
+
+@dataclass
+class Prototypes:
+    """All prototypes of a SS14 repository, indexed by their type."""
+    by_type: dict[str, list[dict]]
+
+    def of_type(self, kind: str) -> list[dict]:
+        """Return all prototypes of the given type (entity, tile, decal, ...)."""
+        return self.by_type.get(kind, [])
+
+    @staticmethod
+    def from_root(root: Path, cache: Path = None,
+                  cancel: threading.Event = None) -> "Prototypes":
+        """Parse every prototype file of a SS14 repository exactly once.
+
+        If a cache file is given, files whose size and modification time did
+        not change since the last run are taken from it instead of parsed.
+        Once `cancel` is set, `Cancelled` is raised before the next file.
+        """
+        yml_dir = root / "Resources/Prototypes"
+        with PROFILE.phase("prototypes: glob"):
+            files = sorted(x for x in yml_dir.glob("**/*.yml") if x.is_file())
+        PROFILE.count("prototypes: files", len(files))
+
+        with PROFILE.phase("prototypes: read cache"):
+            cached = _read_cache(cache, root)
+        entries = {}
+        changed = len(cached) != len(files)
+
+        by_type: dict[str, list[dict]] = {}
+        for file in files:
+            if cancel is not None and cancel.is_set():
+                raise Cancelled()
+            key = file.relative_to(yml_dir).as_posix()
+            stat = file.stat()
+            entry = cached.get(key)
+            unchanged = entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns
+            if unchanged and entry[2] is not False:
+                documents = entry[2]
+                PROFILE.count("prototypes: cache hits")
+                if documents is None:
+                    eprint(f"Error parsing YAML file {file}: unchanged since the last run")
+            else:
+                changed = changed or not unchanged
+                try:
+                    with PROFILE.phase("prototypes: parse"):
+                        documents = load_yaml(file.read_text("UTF-8"))
+                except yaml.YAMLError as e:
+                    eprint(f"Error parsing YAML file {file}: {str(e)}")
+                    # Remembered as broken, so it isn't parsed again until it changes.
+                    documents = None
+            entries[key] = (stat.st_size, stat.st_mtime_ns, documents)
+
+            if not isinstance(documents, list):
+                continue
+
+            for prototype in documents:
+                if not isinstance(prototype, dict) or "type" not in prototype:
+                    continue  # alias or null entry?
+                by_type.setdefault(prototype["type"], []).append(prototype)
+
+        if cache is not None and changed:
+            with PROFILE.phase("prototypes: write cache"):
+                _write_cache(cache, root, entries)
+
+        return Prototypes(by_type)
+
+
+def _read_cache(cache: Path, root: Path) -> dict[str, tuple[int, int, list | None | bool]]:
+    """(Internal) Read the parsed files of a previous run, if usable.
+
+    The cache is in the output directory, which may come from somewhere else. So it is
+    stored with `marshal`, which only holds plain values and can't run code when read.
+    """
+    if cache is None or not cache.exists():
+        return {}
+    try:
+        content = marshal.loads(cache.read_bytes())
+    except Exception:  # pylint: disable=broad-exception-caught
+        # A broken cache is just a cold cache.
+        return {}
+    if not isinstance(content, dict) \
+            or content.get("version") != CACHE_VERSION \
+            or content.get("marshal") != marshal.version \
+            or content.get("root") != str(root.resolve()) \
+            or not isinstance(content.get("files"), dict):
+        return {}
+    return content["files"]
+
+
+def _write_cache(cache: Path, root: Path, entries: dict[str, tuple[int, int, list | None]]):
+    """(Internal) Store the parsed files for the next run."""
+    cache.parent.mkdir(parents=True, exist_ok=True)
+    content = {"version": CACHE_VERSION, "marshal": marshal.version,
+               "root": str(root.resolve()), "files": entries}
+    try:
+        data = marshal.dumps(content)
+    except ValueError:
+        # Values marshal can't hold (like dates), those files are stored as False
+        # and parsed again every run.
+        content["files"] = {key: entry if _marshallable(entry) else (*entry[:2], False)
+                            for (key, entry) in entries.items()}
+        data = marshal.dumps(content)
+    tmp = cache.with_name(cache.name + ".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, cache)
+
+
+def _marshallable(value) -> bool:
+    """(Internal) Whether `marshal` can store the value."""
+    try:
+        marshal.dumps(value)
+    except ValueError:
+        return False
+    return True
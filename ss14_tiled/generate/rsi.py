@@ -0,0 +1,89 @@
+"""Everything for reading RSIs (the sprite directories with a meta.json)."""
+import json
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+
+from ..shared import PROFILE
+
+# YAML has some eager boolean parsing, so a state called "on" ends up as True.
+YES = ("y", "yes", "true", "on")
+NO = ("n", "no", "false", "off")
+
+
+@dataclass(frozen=True)
+class State:
+    """A single state of a RSI."""
+    name: str
+    directions: int
+    # Frames per direction, the sprite-sheet holds directions * frames images.
+    frames: int
+
+
+@dataclass
+class RSI:
+    """The parsed meta.json of a RSI."""
+    path: Path
+    width: int
+    height: int
+    states: dict[str, State]
+    # States matching YAML's True and False (see YES and NO).
+    booleans: dict[bool, State]
+
+    def state(self, name) -> State | None:
+        """Find a state by the name used in a prototype."""
+        if isinstance(name, bool):
+            return self.booleans.get(name)
+        return self.states.get(str(name))
+
+    @staticmethod
+    def from_dict(path: Path, d: dict) -> "RSI":
+        """Build this object from the content of a meta.json."""
+        states = {}
+        booleans = {}
+        for x in d["states"]:
+            directions = x.get("directions", 1)
+            frames = len(x["delays"][0]) if "delays" in x else 1
+            state = State(x["name"], directions, frames)
+            # The first state wins, like it does in the game.
+            states.setdefault(state.name, state)
+            if state.name.lower() in YES:
+                booleans.setdefault(True, state)
+            elif state.name.lower() in NO:
+                booleans.setdefault(False, state)
+        return RSI(path, d["size"]["x"], d["size"]["y"], states, booleans)
+
+
+class RSIRegistry:
+    """Loads the meta.json of every RSI only once."""
+
+    def __init__(self):
+        self._rsis: dict[Path, RSI | None] = {}
+        self._lock = threading.Lock()
+
+    def get(self, path: Path) -> RSI | None:
+        """Return the RSI in the given directory, None if there is none."""
+        with self._lock:
+            if path in self._rsis:
+                PROFILE.count("rsi: cache hits")
+                return self._rsis[path]
+
+        meta_file = path / "meta.json"
+        rsi = None
+        with PROFILE.phase("rsi: load"):
+            if meta_file.exists():
+                # Some files have a BOM for some reason...
+                json_text = meta_file.read_text("UTF-8").replace("\uFEFF", "")
+                rsi = RSI.from_dict(path, json.loads(json_text))
+
+        with self._lock:
+            return self._rsis.setdefault(path, rsi)
+
+    def clear(self):
+        """Forget all RSIs, e.g. because the files may have changed."""
+        with self._lock:
+            self._rsis.clear()
+
+
+# Every process has its own registry.
+RSIS = RSIRegistry()
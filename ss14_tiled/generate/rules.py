@@ -0,0 +1,176 @@
+"""Everything for the rules which entities end up in the tile-sets (see the README)."""
+from dataclasses import dataclass, field, fields
+from pathlib import Path
+
+import yaml
+
+DEFAULT_RULES = {
+    "filters": [
+        {"name": "abstract", "abstract": True},
+        {"name": "no sprite", "without_components": ["Sprite"]},
+        {"name": "despawns", "components": ["TimedDespawn"]},
+        {"name": "debug", "suffixes": ["DEBUG", "Admeme", "DO NOT MAP"]},
+        {"name": "hidden", "categories": ["HideSpawnMenu"]},
+        {"name": "controls and spawners", "components": ["Input", "RandomHumanoidSpawner"]},
+    ],
+    "groups": [
+        {"name": "Pipes", "ancestors": ["GasPipeBase", "DisposalPipeBase"]},
+        {"name": "Windoors", "ancestors": ["BaseWindoor"]},
+        {"name": "Eat and Drink", "ancestors": ["FoodBase", "DrinkBase"]},
+        {"name": "Clothes", "ancestors": ["Clothing"]},
+        {"name": "Closets and Lockers", "ancestors": ["ClosetBase", "BaseWallCloset"]},
+        {"name": "Airlocks", "ids": ["Airlock"], "ancestors": ["Airlock", "BaseFirelock"]},
+        {"name": "Windows", "ids": ["Window", "WindowDirectional"],
+         "ancestors": ["Window", "WindowDirectional", "PlastitaniumWindowBase"]},
+        {"name": "Walls", "ids": ["WallShuttleDiagonal", "WallPlastitaniumDiagonalIndestructible"],
+         "ancestors": ["WallShuttleDiagonal", "BaseWall"]},
+        {"name": "Computers", "ancestors": ["BaseComputer"]},
+        {"name": "Markers", "ancestors": ["MarkerBase"]},
+        {"name": "Signs", "ancestors": ["BaseSign"]},
+    ],
+}
+
+# Group of all entities that no other group wants.
+OTHER = "Other"
+
+
+def _strings(value, where: str) -> tuple[str, ...]:
+    """A single string or a list of them, as a tuple."""
+    if isinstance(value, str):
+        return (value,)
+    if isinstance(value, list) and all(isinstance(x, str) for x in value):
+        return tuple(value)
+    raise ValueError(f"Expected a string or a list of strings for {where}, not '{value}'.")
+
+
+@dataclass(frozen=True)
+class FilterRule:
+    """Removes every entity that matches any of its conditions."""
+    name: str
+    # Abstract entities (only bases for others).
+    abstract: bool = False
+    # Entities that have any of these components.
+    components: frozenset[str] = frozenset()
+    # Entities that miss any of these components.
+    without_components: frozenset[str] = frozenset()
+    # Entities whose suffix contains any of these.
+    suffixes: tuple[str, ...] = ()
+    # Entities in any of these categories.
+    categories: tuple[str, ...] = ()
+
+    def matches(self, entity: dict, types: set[str]) -> bool:
+        """Whether an entity with the given component types is removed."""
+        if self.abstract and "abstract" in entity:
+            return True
+        if not self.components.isdisjoint(types):
+            return True
+        if not self.without_components <= types:
+            return True
+        if "suffix" in entity and any(x in str(entity["suffix"]) for x in self.suffixes):
+            return True
+        if "categories" in entity and any(x in (entity["categories"] or ())
+                                          for x in self.categories):
+            return True
+        return False
+
+    @staticmethod
+    def from_dict(d: dict) -> "FilterRule":
+        """Build this object from an entry of a rules file."""
+        if not isinstance(d, dict) or not isinstance(d.get("name"), str):
+            raise ValueError(f"Every filter needs a name, not '{d}'.")
+        known = {x.name for x in fields(FilterRule)}
+        for key in d:
+            if key not in known:
+                raise ValueError(f"Unknown key '{key}' in filter '{d['name']}'.")
+        where = f"filter '{d['name']}'"
+        return FilterRule(
+            d["name"],
+            bool(d.get("abstract", False)),
+            frozenset(_strings(d.get("components", []), where)),
+            frozenset(_strings(d.get("without_components", []), where)),
+            _strings(d.get("suffixes", []), where),
+            _strings(d.get("categories", []), where),
+        )
+
+
+@dataclass(frozen=True)
+class GroupRule:
+    """A tile-set with the entities that have any of the ids or ancestors."""
+    name: str
+    ids: frozenset[str] = frozenset()
+    ancestors: frozenset[str] = frozenset()
+
+    @staticmethod
+    def from_dict(d: dict) -> "GroupRule":
+        """Build this object from an entry of a rules file."""
+        if not isinstance(d, dict) or not isinstance(d.get("name"), str):
+            raise ValueError(f"Every group needs a name, not '{d}'.")
+        if d["name"] == OTHER:
+            raise ValueError(f"'{OTHER}' is for all entities without a group, it has no rules.")
+        for key in d:
+            if key not in ("name", "ids", "ancestors"):
+                raise ValueError(f"Unknown key '{key}' in group '{d['name']}'.")
+        where = f"group '{d['name']}'"
+        return GroupRule(
+            d["name"],
+            frozenset(_strings(d.get("ids", []), where)),
+            frozenset(_strings(d.get("ancestors", []), where)),
+        )
+
+
+def apply_filters(entities: dict[str, dict], filters: list[FilterRule]) \
+        -> tuple[dict[str, dict], dict[str, int]]:
+    """Go over the entities once, and keep those that no filter matches.
+
+    Returns the kept entities, and how many entities each filter removed.
+    An entity only counts for the first filter that matches.
+    """
+    removed = {x.name: 0 for x in filters}
+    kept = {}
+    for key, entity in entities.items():
+        types = {x["type"] for x in entity.get("components") or []}
+        rule = next((x for x in filters if x.matches(entity, types)), None)
+        if rule is None:
+            kept[key] = entity
+        else:
+            removed[rule.name] += 1
+    return kept, removed
+
+
+@dataclass
+class Rules:
+    """All rules, the defaults with the changes of a rules file."""
+    filters: list[FilterRule] = field(default_factory=list)
+    groups: list[GroupRule] = field(default_factory=list)
+
+    @staticmethod
+    def from_dict(d: dict, base: "Rules" = None) -> "Rules":
+        """Build this object from the content of a rules file, on top of the given rules."""
+        if not isinstance(d, dict):
+            raise ValueError("A rules file has to be a mapping.")
+        for key in d:
+            if key not in ("filters", "groups"):
+                raise ValueError(f"Unknown key '{key}' in rules.")
+
+        filters = {x.name: x for x in base.filters} if base else {}
+        for entry in d.get("filters") or []:
+            rule = FilterRule.from_dict(entry)
+            filters[rule.name] = rule
+        groups = {x.name: x for x in base.groups} if base else {}
+        for entry in d.get("groups") or []:
+            rule = GroupRule.from_dict(entry)
+            groups[rule.name] = rule
+        return Rules(list(filters.values()), list(groups.values()))
+
+    @staticmethod
+    def default() -> "Rules":
+        """The rules used without a rules file."""
+        return Rules.from_dict(DEFAULT_RULES)
+
+    @staticmethod
+    def from_file(path: Path = None) -> "Rules":
+        """The default rules, changed by the given file (if any)."""
+        rules = Rules.default()
+        if path is None:
+            return rules
+        return Rules.from_dict(yaml.safe_load(path.read_text("UTF-8")) or {}, rules)
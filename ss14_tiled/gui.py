@@ -10,13 +10,13 @@ from pathlib import Path
 from PyQt6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
     QPushButton, QLabel, QLineEdit, QFileDialog, QProgressBar,
-    QTextEdit, QStatusBar
+    QTextEdit, QStatusBar, QSpinBox, QComboBox, QCheckBox
 )
 from PyQt6.QtCore import Qt, pyqtSignal, QObject
 from PyQt6.QtGui import QFont
 
 from .generate import generate
-from .shared import eprint
+from .shared import EXECUTORS, Cancelled, Options, eprint
 
 # Suppress libpng warnings about color profiles
 os.environ['PYTHONWARNINGS'] = 'ignore::UserWarning'
@@ -26,6 +26,7 @@ warnings.filterwarnings('ignore')
 class WorkerSignals(QObject):
     """Signals for worker thread."""
     finished = pyqtSignal()
+    cancelled = pyqtSignal()
     error = pyqtSignal(str)
     progress = pyqtSignal(str)
     progress_percent = pyqtSignal(int)
@@ -33,10 +34,11 @@ class WorkerSignals(QObject):
 
 class GenerateWorker(threading.Thread):
     """Worker thread for generation task."""
-    def __init__(self, ss14_path: Path, output_path: Path):
+    def __init__(self, ss14_path: Path, output_path: Path, options: Options = None):
         super().__init__(daemon=True)
         self.ss14_path = ss14_path
         self.output_path = output_path
+        self.options = options or Options()
         self.signals = WorkerSignals()
         self._stop_event = threading.Event()
 
@@ -50,6 +52,7 @@ class GenerateWorker(threading.Thread):
             self.signals.progress.emit(f"[{self._get_timestamp()}] Starting tileset generation...\n")
             self.signals.progress.emit(f"[{self._get_timestamp()}] SS14 Repository: {self.ss14_path}\n")
             self.signals.progress.emit(f"[{self._get_timestamp()}] Output Directory: {self.output_path}\n")
+            self.signals.progress.emit(f"[{self._get_timestamp()}] Workers: {self.options.jobs} ({self.options.executor})\n")
             self.signals.progress.emit(f"[{self._get_timestamp()}] Validating repository structure...\n")
             self.signals.progress_percent.emit(5)
             
@@ -94,7 +97,8 @@ class GenerateWorker(threading.Thread):
                     self.signals.progress_percent.emit(percent)
                 
                 try:
-                    generate(self.ss14_path, progress_callback, self.output_path)
+                    generate(self.ss14_path, progress_callback, self.output_path, self.options,
+                             self._stop_event)
                 finally:
                     sys.stdout = old_stdout
                     sys.stderr = old_stderr
@@ -111,6 +115,10 @@ class GenerateWorker(threading.Thread):
                 self.signals.finished.emit()
             finally:
                 os.chdir(old_cwd)
+        except Cancelled:
+            self.signals.progress.emit(f"[{self._get_timestamp()}] Finished tile sets are kept, "
+                                       "the others are left as they were.\n")
+            self.signals.cancelled.emit()
         except Exception as e:
             error_msg = str(e) if str(e) else type(e).__name__
             tb = traceback.format_exc()
@@ -189,6 +197,33 @@ class SS14TiledGUI(QMainWindow):
         output_layout.addWidget(output_browse_button)
         main_layout.addLayout(output_layout)
         
+        # Worker settings
+        workers_layout = QHBoxLayout()
+        workers_label = QLabel("Workers:")
+        workers_label.setMinimumWidth(100)
+        self.jobs_input = QSpinBox()
+        self.jobs_input.setRange(1, 256)
+        self.jobs_input.setValue(os.cpu_count() or 1)
+        self.jobs_input.setToolTip("Number of images that are created in parallel")
+        self.executor_input = QComboBox()
+        self.executor_input.addItems(EXECUTORS)
+        self.executor_input.setToolTip(
+            "process: fastest, thread: fewer resources, serial: one by one (for profiling)")
+        
+        workers_layout.addWidget(workers_label)
+        workers_layout.addWidget(self.jobs_input)
+        workers_layout.addWidget(self.executor_input)
+        self.atlas_input = QCheckBox("Atlas")
+        self.atlas_input.setToolTip(
+            "Pack the images of each tile-set into a few sprite-sheets (needs Tiled 1.9 or newer)")
+        workers_layout.addWidget(self.atlas_input)
+        self.incremental_input = QCheckBox("Incremental")
+        self.incremental_input.setToolTip(
+            "Only re-create the images whose inputs changed since the last run")
+        workers_layout.addWidget(self.incremental_input)
+        workers_layout.addStretch()
+        main_layout.addLayout(workers_layout)
+        
         # Buttons
         button_layout = QHBoxLayout()
         self.generate_button = QPushButton("Generate Tileset")
@@ -288,10 +323,15 @@ class SS14TiledGUI(QMainWindow):
         self.statusBar().showMessage("Generating tileset...")
         
         # Create and start worker thread
-        self.worker = GenerateWorker(ss14_path, self.output_path)
+        options = Options(jobs=self.jobs_input.value(),
+                          executor=self.executor_input.currentText(),
+                          atlas=self.atlas_input.isChecked(),
+                          incremental=self.incremental_input.isChecked())
+        self.worker = GenerateWorker(ss14_path, self.output_path, options)
         self.worker.signals.progress.connect(self.append_log)
         self.worker.signals.progress_percent.connect(self.update_progress)
         self.worker.signals.finished.connect(self.generation_finished)
+        self.worker.signals.cancelled.connect(self.cancel_generation_finished)
         self.worker.signals.error.connect(self.generation_error)
         self.worker.start()
     
@@ -300,7 +340,9 @@ class SS14TiledGUI(QMainWindow):
         if self.worker:
             self.log_output.append("\n[WARNING] Cancellation requested...")
             self.worker.stop()
-            self.cancel_generation_finished()
+            # The workers finish their current images first.
+            self.cancel_button.setEnabled(False)
+            self.statusBar().showMessage("Cancelling...")
     
     def cancel_generation_finished(self):
         """Handle generation cancellation."""
@@ -316,6 +358,8 @@ class SS14TiledGUI(QMainWindow):
     
     def update_progress(self, percent: int):
         """Update the progress bar."""
+        if self.progress_bar.maximum() == 0:
+            self.progress_bar.setMaximum(100)  # Not indeterminate anymore
         self.progress_bar.setValue(min(100, max(0, percent)))
     
     def generation_finished(self):
@@ -1,5 +1,9 @@
 """GUI entry point for SS14 Tiled application."""
+from multiprocessing import freeze_support
+
 from ss14_tiled.gui import main
 
 if __name__ == "__main__":
+    # Worker processes of the frozen EXE start through here.
+    freeze_support()
     main()
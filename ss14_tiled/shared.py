@@ -1,18 +1,25 @@
 """Shared stuffs and utility functions."""
+import hashlib
+import io
 import json
+import os
 import sys
-import xml.etree.ElementTree as ET
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import (Executor, Future, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+from contextlib import contextmanager, nullcontext, redirect_stderr
 from dataclasses import dataclass
+from multiprocessing import Event, Value, parent_process
 from pathlib import Path
+from typing import Callable
+from xml.sax.saxutils import escape
 
-try:
-    from PIL import Image as PILImage
-    HAS_PIL = True
-except ImportError:
-    HAS_PIL = False
+import cv2
+import numpy as np
 
-# Global cache for fixed PNG files to avoid reprocessing
-_PNG_FIX_CACHE = set()
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
 
 
 def eprint(*args, **kwargs):
@@ -20,57 +27,448 @@ def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
-def fix_png_color_profile(image_path: Path) -> None:
-    """Fix PNG color profile issues by removing problematic iCCP chunks.
-    
-    Rewrites PNG files to remove incorrect color profile metadata that causes
-    libpng warnings without affecting the actual image data.
-    Uses caching to avoid reprocessing the same file.
+def strip_png_chunks(data: bytes, chunk_types: tuple[bytes, ...]) -> bytes:
+    """Remove chunks of the given types from the content of a PNG file.
+
+    Only the chunk headers are looked at, the pixels are not touched.
+    Returns the data unchanged if there is nothing to remove (or if it isn't a PNG).
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        return data
+
+    keep = []
+    start = pos = len(PNG_SIGNATURE)
+    while pos + 8 <= len(data):
+        length = int.from_bytes(data[pos:pos+4], "big")
+        chunk_type = data[pos+4:pos+8]
+        end = pos + 12 + length  # length + type + data + CRC
+        if chunk_type in chunk_types:
+            keep.append(data[start:pos])
+            start = end
+        elif chunk_type in (b"IDAT", b"IEND"):
+            break  # Profiles have to come before the image data.
+        pos = end
+
+    if not keep:
+        return data
+    keep.append(data[start:])
+    return data[:len(PNG_SIGNATURE)] + b"".join(keep)
+
+
+def read_image(path: Path):
+    """Like `cv2.imread(path, cv2.IMREAD_UNCHANGED)`, but without color profiles.
+
+    Some sprites come with broken iCCP chunks, which make libpng complain.
+    They are dropped in memory, the file itself is never changed.
     """
-    if not HAS_PIL:
-        return
-    
-    # Check cache first
-    if str(image_path) in _PNG_FIX_CACHE:
-        return
-    
     try:
-        if image_path.suffix.lower() != '.png':
+        data = path.read_bytes()
+    except OSError:
+        return None
+    data = strip_png_chunks(data, (b"iCCP",))
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+
+
+class Profile:
+    """Time spent in each phase of a generate() run, and how often it ran.
+
+    Does nothing unless enabled (see `Options.profile`). The worker processes have
+    their own, and send what they measured back with their results (see `run_chunk`).
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        # Phase -> [seconds, count]
+        self.phases: dict[str, list] = {}
+        # Name -> number, e.g. items or cache hits.
+        self.counts: dict[str, int] = {}
+
+    @contextmanager
+    def phase(self, name: str, count: int = 1):
+        """Measure the time of the block as (part of) a phase."""
+        if not self.enabled:
+            yield
             return
-        
-        # Open the PNG file
-        img = PILImage.open(image_path)
-        
-        # Create a clean image without ICC profiles
-        # Save with default parameters which won't include problematic profiles
-        data = list(img.getdata())
-        
-        if img.mode == 'RGBA':
-            clean_img = PILImage.new('RGBA', img.size)
-        elif img.mode == 'RGB':
-            clean_img = PILImage.new('RGB', img.size)
-        elif img.mode == 'LA':
-            clean_img = PILImage.new('LA', img.size)
-        elif img.mode == 'L':
-            clean_img = PILImage.new('L', img.size)
-        elif img.mode == 'P':
-            # Palette mode - keep palette but remove iCCP
-            clean_img = PILImage.new('P', img.size)
-            if img.palette:
-                clean_img.putpalette(img.palette.getdata()[1])
-        else:
-            clean_img = PILImage.new(img.mode, img.size)
-        
-        clean_img.putdata(data)
-        
-        # Save without any color profiles, strips iCCP chunks
-        clean_img.save(image_path, 'PNG', icc_profile=None)
-        
-        # Mark as fixed in cache
-        _PNG_FIX_CACHE.add(str(image_path))
-    except Exception:
-        # Silently fail - file is still usable even if profile isn't fixed
-        pass
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, count)
+
+    def add(self, name: str, seconds: float, count: int = 1):
+        """Add time to a phase."""
+        if not self.enabled:
+            return
+        with self._lock:
+            phase = self.phases.setdefault(name, [0.0, 0])
+            phase[0] += seconds
+            phase[1] += count
+
+    def count(self, name: str, number: int = 1):
+        """Count something that isn't timed."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + number
+
+    def take(self) -> tuple[dict, dict] | None:
+        """Everything measured so far, which is forgotten here (to send it to another process)."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            taken = (self.phases, self.counts)
+            self.phases, self.counts = {}, {}
+        return taken
+
+    def merge(self, taken: tuple[dict, dict] | None):
+        """Add what another process measured (see `take`)."""
+        if taken is None:
+            return
+        phases, counts = taken
+        for name, (seconds, count) in phases.items():
+            self.add(name, seconds, count)
+        for name, number in counts.items():
+            self.count(name, number)
+
+    def clear(self, enabled: bool = False):
+        """Forget everything, and start or stop measuring."""
+        with self._lock:
+            self.enabled = enabled
+            self.phases = {}
+            self.counts = {}
+
+    def report(self) -> dict:
+        """Everything measured, the phases with the most time first."""
+        with self._lock:
+            phases = sorted(self.phases.items(), key=lambda x: -x[1][0])
+            return {
+                "phases": {name: {"seconds": round(seconds, 6), "count": count}
+                           for (name, (seconds, count)) in phases},
+                "counts": dict(sorted(self.counts.items())),
+            }
+
+
+# Every process measures on its own, see `Profile`.
+PROFILE = Profile()
+
+
+class ImageCache:
+    """Decoded images by path, dropping the least recently used ones when over budget.
+
+    Many entities share the same sprites, and every direction of an entity
+    reads them again, so most decoding is repeated work without this.
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self._images = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        # Shared with the worker processes, see `init_worker`.
+        self.hits = Value("q", 0)
+        self.misses = Value("q", 0)
+
+    def read(self, path: Path):
+        """Read an image as BGRA, or None if it can't be read.
+
+        The result is shared, so it is read-only. Copy it before changing it.
+        """
+        key = str(path)
+        with self._lock:
+            img = self._images.get(key)
+            if img is not None:
+                self._images.move_to_end(key)
+        if img is not None:
+            with self.hits.get_lock():
+                self.hits.value += 1
+            return img
+        with self.misses.get_lock():
+            self.misses.value += 1
+
+        with PROFILE.phase("images: read"):
+            img = read_image(path)
+        if img is None:
+            return None
+        if img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGRA)
+        elif img.shape[2] == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_RGB2RGBA)
+        img.flags.writeable = False
+
+        with self._lock:
+            if key not in self._images:
+                self._images[key] = img
+                self._size += img.nbytes
+            # Always keep the newest one, even if it is over budget on its own.
+            while self._size > self.budget and len(self._images) > 1:
+                _, dropped = self._images.popitem(last=False)
+                self._size -= dropped.nbytes
+        return img
+
+    def clear(self):
+        """Forget all images and reset the counters."""
+        with self._lock:
+            self._images.clear()
+            self._size = 0
+        self.hits.value = 0
+        self.misses.value = 0
+
+
+# Every process has its own images, but they all count into the same hits/misses.
+IMAGES = ImageCache(256 * 1024 * 1024)
+
+
+@dataclass
+class Options:
+    """Settings of a generate() run."""
+    # Skip images whose inputs did not change since the last run.
+    incremental: bool = False
+    # Number of parallel workers, one per CPU if not set.
+    jobs: int = None
+    # How the workers run: "process", "thread" or "serial" (no workers at all).
+    executor: str = "process"
+    # Memory for decoded sprites, of all worker processes together.
+    image_cache_mb: int = 256
+    # File with rules which entities end up in the tile-sets, the defaults if not set.
+    rules: Path = None
+    # Pack the images of each tile-set into a few sprite-sheets (see `create_tsx`).
+    atlas: bool = False
+    # Write a JSON report of where the time went (see `Profile`) to this file.
+    profile: Path = None
+    # Write the statistics of cProfile (of this process only) to this file.
+    cprofile: Path = None
+
+
+EXECUTORS = ("process", "thread", "serial")
+
+
+class Cancelled(Exception):
+    """The run was cancelled (see `run_stages`)."""
+
+
+class StopFlag:
+    """Tells the jobs of a run to stop, in this process and in the workers.
+
+    The worker processes get the event of the pool when they start (see `make_executor`).
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def is_set(self) -> bool:
+        """Whether the jobs should stop."""
+        return self.event.is_set()
+
+    def set(self):
+        """Stop the jobs."""
+        self.event.set()
+
+
+# Every process checks its own, but they are all the same event during a run.
+STOP = StopFlag()
+
+
+class SerialExecutor(Executor):
+    """Executor that runs every job right away in the calling thread.
+
+    Slow, but deterministic and easy to profile or debug.
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:  # pylint: disable=broad-exception-caught
+            future.set_exception(e)
+        return future
+
+
+def make_executor(options: Options) -> Executor:
+    """Create the executor the options ask for."""
+    if options.executor not in EXECUTORS:
+        raise ValueError(f"Unknown executor '{options.executor}', expected one of {EXECUTORS}.")
+    if options.executor == "serial":
+        return SerialExecutor()
+
+    jobs = options.jobs or os.cpu_count() or 1
+    if options.executor == "thread":
+        return ThreadPoolExecutor(max_workers=jobs)
+    if sys.platform == "win32":
+        jobs = min(jobs, 61)  # Windows can't wait on more processes.
+    # The workers can't see an event of this process, so all of them share a new one.
+    stop = Event()
+    STOP.event = stop
+    return ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                               initargs=(options, IMAGES.hits, IMAGES.misses, stop, jobs))
+
+
+def init_worker(options: Options, hits=None, misses=None, stop=None, processes: int = 1):
+    """Set up the caches of a (worker) process for a generate() run.
+
+    The image cache budget of the options is split over all `processes`.
+    """
+    STOP.event = stop if stop is not None else threading.Event()
+    IMAGES.clear()
+    IMAGES.budget = options.image_cache_mb * 1024 * 1024 // processes
+    PROFILE.clear(options.profile is not None)
+    if hits is not None:
+        IMAGES.hits = hits
+        IMAGES.misses = misses
+
+
+@contextmanager
+def executor_for(options: Options, executor: Executor = None):
+    """Use the given executor, or a new one made from the options."""
+    if executor is not None:
+        yield executor
+        return
+    with make_executor(options) as new_executor:
+        yield new_executor
+
+
+@dataclass
+class Stage:
+    """The jobs of (a part of) a generator, see `run_stages`."""
+    # Runs in the workers for every job, so it has to be picklable (module level).
+    work: Callable
+    jobs: list
+    # Runs in this process, in order, with the index of each job and its result.
+    collect: Callable[[int, object], None]
+    # Runs in this process once all results are collected, e.g. to write the tile-set.
+    finish: Callable[[], None]
+    # Name in the profile (see `Profile`).
+    name: str = "jobs"
+    # Number of items (images) of each job for the progress, 1 each if not set.
+    items: list[int] = None
+
+    def total(self) -> int:
+        """Number of items of all jobs."""
+        return len(self.jobs) if self.items is None else sum(self.items)
+
+
+def run_chunk(work: Callable, chunk: list, name: str = "jobs") -> tuple[list, object, str]:
+    """Run a job function on a chunk of jobs.
+
+    Returns the results, what was measured meanwhile (see `Profile.take`),
+    and the warnings of a worker process (they belong to the output of the run,
+    which e.g. the GUI only captures in its own process).
+    """
+    results = []
+    warnings = io.StringIO()
+    with redirect_stderr(warnings) if parent_process() is not None else nullcontext(), \
+            PROFILE.phase(f"stage {name}: work", len(chunk)):
+        for job in chunk:
+            # The results are thrown away anyway, don't start on new images.
+            if STOP.is_set():
+                raise Cancelled()
+            results.append(work(job))
+    return results, PROFILE.take(), warnings.getvalue()
+
+
+def run_stages(stages: list[Stage], executor: Executor, options: Options,
+               progress_callback=None, chunksize: int = 16, cancel: threading.Event = None):
+    """Run the jobs of all stages as one stream on the executor.
+
+    The workers go on with the next stages while the results of the earlier ones
+    are collected and written, so they don't wait for each other.
+    Only a few chunks per worker are queued at a time, which keeps the memory bounded.
+    The progress is reported after every chunk, as (items done, items of all stages).
+
+    Once `cancel` is set, the workers stop after their current job and `Cancelled` is raised.
+    Stages that were finished before are kept. The others don't write their tile-sets
+    and caches, so these still match each other, and the images of their jobs are
+    simply made again by the next run.
+    """
+    # A cancel of an earlier run doesn't stop this one.
+    STOP.event.clear()
+    depth = 4 * (options.jobs or os.cpu_count() or 1)
+    total = sum(x.total() for x in stages)
+    done = 0
+    # (stage, index of the first job, future of the chunk, is it the last chunk)
+    pending = deque()
+
+    def check():
+        if cancel is not None and cancel.is_set():
+            STOP.set()
+            raise Cancelled()
+
+    def result_of(future: Future):
+        if cancel is None:
+            return future.result()
+        while True:
+            check()
+            try:
+                return future.result(timeout=0.1)
+            except TimeoutError:
+                continue
+
+    def collect_next():
+        nonlocal done
+        stage, start, future, last = pending.popleft()
+        if future is not None:
+            results, measured, warnings = result_of(future)
+            PROFILE.merge(measured)
+            if warnings:
+                sys.stderr.write(warnings)
+            with PROFILE.phase(f"stage {stage.name}: collect", len(results)):
+                for i, result in enumerate(results, start):
+                    stage.collect(i, result)
+            done += len(results) if stage.items is None \
+                else sum(stage.items[start:start+len(results)])
+            if progress_callback:
+                progress_callback(done, total)
+        if last:
+            check()
+            with PROFILE.phase(f"stage {stage.name}: finish"):
+                stage.finish()
+
+    try:
+        for stage in stages:
+            if not stage.jobs:
+                pending.append((stage, 0, None, True))
+            for start in range(0, len(stage.jobs), chunksize):
+                check()
+                chunk = stage.jobs[start:start+chunksize]
+                future = executor.submit(run_chunk, stage.work, chunk, stage.name)
+                pending.append((stage, start, future, start + chunksize >= len(stage.jobs)))
+                while len(pending) > depth:
+                    collect_next()
+        while pending:
+            collect_next()
+    except Cancelled:
+        for (_, _, future, _) in pending:
+            if future is not None:
+                future.cancel()
+        raise
+
+
+def file_stamp(path: Path) -> list:
+    """Cheap stand-in for the content of a file: [name, size, modification time]."""
+    try:
+        stat = path.stat()
+    except OSError:
+        return [path.name, None, None]
+    return [path.name, stat.st_size, stat.st_mtime_ns]
+
+
+# Bump this whenever the same inputs can give other images, as in a change of the
+# compositing, tinting or cropping, so incremental runs make all of them again.
+RENDER_VERSION = 1
+
+
+def hash_inputs(*inputs) -> str:
+    """Hash everything that goes into an output image, and the version of the rendering."""
+    data = json.dumps([RENDER_VERSION, inputs], sort_keys=True, default=str)
+    return hashlib.blake2b(data.encode("UTF-8"), digest_size=16).hexdigest()
+
+
+def write_if_changed(path: Path, content: bytes) -> bool:
+    """Write a file, unless it already has exactly this content."""
+    if path.exists() and path.read_bytes() == content:
+        return False
+    path.write_bytes(content)
+    return True
 
 
 @dataclass
@@ -81,51 +479,325 @@ class Image:
     height: str
 
 
-@dataclass
-class CacheJSON:
-    """Cache file content."""
-    ids: list[str]
-    images: list[Image]
+class TileCache:
+    """The tiles of a tile-set, with the images and fingerprints they were made from.
 
-    @staticmethod
-    def from_dict(d: dict) -> "CacheJSON":
-        """Build this object recursively from a dict."""
-        images = [Image(x["source"], x["width"], x["height"])
-                  for x in d["images"]]
-        return CacheJSON(d["ids"], images)
+    The order of the tiles is their id in Tiled, so it never changes.
+    On disk, it is a log with one JSON line per tile (id, source, width, height, fingerprint).
+    Changes are appended, a later line for the same tile replaces the earlier one.
+    Older versions repeated some tiles, these copies are kept as lines without an id,
+    so the tiles after them keep their ids too.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        # The id of every tile, copies have the id of the first one (None if read from a file).
+        self.ids: list[str | None] = []
+        self.images: list[Image] = []
+        # Tile id -> fingerprint of the inputs of its image.
+        self.fingerprints: dict[str, str] = {}
+        # Tile id -> index in `ids` and `images`, of the first one if there are copies.
+        self._index: dict[str, int] = {}
+        # Tiles that changed since the last save, in the order they changed.
+        self._changed: dict[str, None] = {}
+        # Lines in the file, to know when it is worth compacting.
+        self._lines = 0
+        # The file has a broken line, nothing can be appended to it.
+        self._broken = False
+        # Any tile changed since it was loaded, unlike `_changed` this survives `save`.
+        self.modified = False
+
+    def update(self, tile_id: str, image: Image, fingerprint: str = None):
+        """Add a tile, or replace the image of a known one without changing its index."""
+        if tile_id in self._index:
+            index = self._index[tile_id]
+            if self.images[index] == image and (
+                    fingerprint is None or self.fingerprints.get(tile_id) == fingerprint):
+                return
+            self.images[index] = image
+        else:
+            self._index[tile_id] = len(self.ids)
+            self.ids.append(tile_id)
+            self.images.append(image)
+        if fingerprint is not None:
+            self.fingerprints[tile_id] = fingerprint
+        self._changed[tile_id] = None
+        self.modified = True
+
+    def _add_copy(self, tile_id: str | None, image: Image):
+        """(Internal) Add a copy of a tile, which only holds the place of the later tiles."""
+        self.ids.append(tile_id)
+        self.images.append(image)
+        self.modified = True
+
+    def unchanged(self, tile_id: str, fingerprint: str, dest: Path) -> bool:
+        """Whether the image of a tile was made from the same inputs."""
+        return self.fingerprints.get(tile_id) == fingerprint \
+            and tile_id in self._index and dest.exists()
+
+    def _line(self, index: int) -> str:
+        tile_id, image = self.ids[index], self.images[index]
+        if tile_id is None or self._index[tile_id] != index:
+            # A copy never changes, so it needs neither an id nor a fingerprint.
+            return json.dumps([None, image.source, image.width, image.height, None]) + "\n"
+        return json.dumps([tile_id, image.source, image.width, image.height,
+                           self.fingerprints.get(tile_id)]) + "\n"
 
     @staticmethod
-    def from_json(path: Path) -> "CacheJSON":
-        """Build this object recursively from a given file."""
+    def load(path: Path) -> "TileCache":
+        """Read the tiles of a tile-set, the file doesn't have to exist (yet).
+
+        Caches of older versions (the same name with ".json") are taken over.
+        """
         path.parent.mkdir(exist_ok=True)
-        existing: CacheJSON = CacheJSON([], [])
-        if path.exists():
-            existing = CacheJSON.from_dict(
-                json.loads(path.read_text("UTF-8")))
-            assert len(existing.ids) == len(existing.images)
-        return existing
+        cache = TileCache(path)
+        cache.read()
+        return cache
+
+    def read(self):
+        """Add the tiles of the file to this (empty) cache, see `load`."""
+        if self.path.exists():
+            with self.path.open(encoding="UTF-8") as f:
+                for line in f:
+                    try:
+                        tile_id, source, width, height, fingerprint = json.loads(line)
+                    except ValueError:
+                        # Cut off while writing, the tile is simply made again.
+                        eprint(f"Ignoring a broken line in '{self.path}'")
+                        self._broken = True
+                        continue
+                    if tile_id is None:
+                        self._add_copy(None, Image(source, width, height))
+                    else:
+                        self.update(tile_id, Image(source, width, height), fingerprint)
+                    self._lines += 1
+            self._changed.clear()
+            self.modified = False
+        elif self.path.with_suffix(".json").exists():
+            old = json.loads(self.path.with_suffix(".json").read_text("UTF-8"))
+            for tile_id, image in zip(old["ids"], old["images"]):
+                image = Image(image["source"], image["width"], image["height"])
+                if tile_id in self._index:
+                    # Older versions added the entities again on every run, keep their ids.
+                    self._add_copy(tile_id, image)
+                else:
+                    self.update(tile_id, image, old.get("fingerprints", {}).get(tile_id))
+
+    def save(self):
+        """Append the changed tiles to the file, or rewrite it if it got too long."""
+        if self._lines + len(self._changed) > 2 * len(self.ids) + 16 \
+                or self._broken or not self.path.exists():
+            tmp = self.path.with_suffix(".tmp")
+            tmp.write_text("".join(self._line(i) for i in range(len(self.ids))), "UTF-8")
+            os.replace(tmp, self.path)
+            self._lines = len(self.ids)
+            self._broken = False
+            # The cache of an older version is taken over now.
+            self.path.with_suffix(".json").unlink(missing_ok=True)
+        elif self._changed:
+            with self.path.open("a", encoding="UTF-8") as f:
+                f.writelines(self._line(self._index[x]) for x in self._changed)
+            self._lines += len(self._changed)
+        self._changed.clear()
+
+
+# Largest width and height of a single atlas page.
+ATLAS_SIZE = 4096
 
 
-def create_tsx(cache: CacheJSON, name: str, output: Path, extra: dict = None):
-    """All the XML writing."""
-    root_element = ET.Element("tileset", name=name)
+def pack_rects(sizes: list[tuple[int, int]], max_size: int = ATLAS_SIZE) \
+        -> list[tuple[int, int, int]]:
+    """Pack rectangles (width, height) onto pages, shelf by shelf, highest first.
 
-    if extra:
-        properties = ET.SubElement(root_element, "properties")
-        for (key, value) in extra.items():
-            ET.SubElement(properties, "property", name=key, value=value)
+    Pages are about square and at most `max_size` big, unless a single rectangle is bigger.
+    Returns (page, x, y) for every rectangle, in the given order.
+    """
+    if not sizes:
+        return []
+    area = sum(w * h for (w, h) in sizes)
+    width = min(max(max(w for (w, _) in sizes), int(area ** 0.5) + 1), max_size)
+
+    positions = [None] * len(sizes)
+    page = x = y = shelf_height = 0
+    for i in sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0], i)):
+        w, h = sizes[i]
+        if x + w > width:
+            x, y, shelf_height = 0, y + shelf_height, 0
+        if y + h > max_size and (x or y):
+            page, x, y, shelf_height = page + 1, 0, 0, 0
+        positions[i] = (page, x, y)
+        x += w
+        shelf_height = max(shelf_height, h)
+    return positions
+
+
+def _atlas_pages(sizes: list[tuple[int, int]]) \
+        -> tuple[list[tuple[int, int, int]], dict[int, tuple[int, int]]]:
+    """(Internal) The positions of `pack_rects`, and the size of every page they fill."""
+    positions = pack_rects(sizes)
+    pages = {}
+    for (width, height), (page, x, y) in zip(sizes, positions):
+        w, h = pages.get(page, (0, 0))
+        pages[page] = (max(w, x + width), max(h, y + height))
+    return positions, pages
+
+
+def _atlas_page(output: Path, page: int) -> Path:
+    """(Internal) Where a page of the atlas of a tile-set is."""
+    return output.parent / ".atlas" / f"{output.stem}_{page}.png"
+
+
+def _atlas_layout(output: Path) -> Path:
+    """(Internal) Where the places of the images in the atlas of a tile-set are kept."""
+    return output.parent / ".atlas" / f"{output.stem}.json"
+
+
+def _remove_atlas_pages(output: Path, first: int = 0):
+    """(Internal) Remove the atlas pages of a tile-set from `first` on, no longer used."""
+    # Pages are numbered without gaps, so the first missing one is the end.
+    while _atlas_page(output, first).exists():
+        _atlas_page(output, first).unlink()
+        first += 1
+
+
+def write_atlas(cache: TileCache, output: Path) -> list[tuple[str, int, int, int, int] | None]:
+    """Pack all images of a tile-set into sprite-sheets, next to the tile-set file.
+
+    The places of the images are kept next to the pages. If no tile changed since the
+    cache was loaded and all pages exist, the pages and places of the last run are used.
+    Returns (source, page width, page height, x, y) for every image,
+    None for those that couldn't be read.
+    """
+    base = output.parent
+    layout = _atlas_layout(output)
+    if not cache.modified and layout.exists():
+        try:
+            rects = [x and tuple(x) for x in json.loads(layout.read_text("UTF-8"))]
+        except ValueError:
+            rects = None
+        if rects is not None and len(rects) == len(cache.images) \
+                and all((base / x[0]).exists() for x in rects if x):
+            PROFILE.count("tsx: atlas kept")
+            return rects
+
+    images = []
+    for image in cache.images:
+        img = cv2.imread(str(base / image.source), cv2.IMREAD_UNCHANGED)
+        if img is None:
+            eprint(f"Failed to read '{image.source}' for the atlas of '{output.name}'")
+        elif img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGRA)
+        elif img.shape[2] == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
+        images.append(img)
+
+    readable = [i for i, img in enumerate(images) if img is not None]
+    positions, pages = _atlas_pages([images[i].shape[1::-1] for i in readable])
+
+    (base / ".atlas").mkdir(exist_ok=True)
+    canvases = {page: np.zeros((h, w, 4), np.uint8) for page, (w, h) in pages.items()}
+    results = [None] * len(images)
+    for i, (page, x, y) in zip(readable, positions):
+        height, width = images[i].shape[:2]
+        canvases[page][y:y+height, x:x+width] = images[i]
+        results[i] = (f"./.atlas/{output.stem}_{page}.png", *pages[page], x, y)
+    for page, canvas in canvases.items():
+        write_if_changed(_atlas_page(output, page), cv2.imencode(".png", canvas)[1].tobytes())
+    _remove_atlas_pages(output, len(pages))
+    write_if_changed(layout, json.dumps(results).encode("UTF-8"))
+    return results
+
+
+def _attributes(**attributes) -> str:
+    """XML attributes, escaped like ElementTree does."""
+    return "".join(f' {key}="{escape(str(value), _ATTRIBUTE_ENTITIES)}"'
+                   for (key, value) in attributes.items())
 
-    for i, image in enumerate(cache.images):
-        ET.SubElement(
-            ET.SubElement(root_element, "tile", id=str(i+1)),
-            "image", source=image.source,
-            width=str(image.width), height=str(image.height))
-    ET.ElementTree(root_element).write(output,
-                                       encoding="UTF-8", xml_declaration=True)
+
+_ATTRIBUTE_ENTITIES = {'"': "&quot;", "\n": "&#10;", "\r": "&#13;", "\t": "&#09;"}
+
+
+class TsxWriter:
+    """Writes a tile-set file tile by tile, without building the XML first.
+
+    Everything goes to a temporary file next to it, which only replaces the
+    tile-set if its content is different. So Tiled doesn't reload unchanged files.
+    """
+
+    def __init__(self, output: Path, name: str, tilecount: int, extra: dict = None):
+        self.output = output
+        self.header = f"<tileset{_attributes(name=name, tilecount=tilecount, columns=0)}>\n"
+        if extra:
+            self.header += " <properties>\n" + "".join(
+                f"  <property{_attributes(name=key, value=value)} />\n"
+                for (key, value) in extra.items()) + " </properties>\n"
+        self._tmp = output.with_name(output.name + ".tmp")
+        self._file = None
+        self._hash = hashlib.blake2b()
+
+    def _write(self, text: str):
+        data = text.encode("UTF-8")
+        self._hash.update(data)
+        self._file.write(data)
+
+    def __enter__(self) -> "TsxWriter":
+        self._file = self._tmp.open("wb")
+        self._write("<?xml version='1.0' encoding='UTF-8'?>\n" + self.header)
+        return self
+
+    def tile(self, tile_id: int, image: Image, rect: tuple = None):
+        """Add a tile with its own image, or with a part (`rect`) of an atlas page."""
+        if rect is None:
+            tile = _attributes(id=tile_id)
+            image = _attributes(source=image.source, width=image.width, height=image.height)
+        else:
+            source, page_width, page_height, x, y = rect
+            tile = _attributes(id=tile_id, x=x, y=y, width=image.width, height=image.height)
+            image = _attributes(source=source, width=page_width, height=page_height)
+        self._write(f" <tile{tile}><image{image} /></tile>\n")
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self._file.close()
+            self._tmp.unlink()
+            return
+        self._write("</tileset>\n")
+        self._file.close()
+        if self.output.exists():
+            with self.output.open("rb") as f:
+                if hashlib.file_digest(f, "blake2b").digest() == self._hash.digest():
+                    self._tmp.unlink()
+                    return
+        os.replace(self._tmp, self.output)
+
+
+def create_tsx(cache: TileCache, name: str, output: Path, extra: dict = None,
+               atlas: bool = False):
+    """All the XML writing.
+
+    With `atlas`, the images are packed into a few sprite-sheets, and every tile
+    is a part of one of them (needs Tiled 1.9 or newer).
+    """
+    if atlas:
+        with PROFILE.phase("tsx: atlas", len(cache.images)):
+            rects = write_atlas(cache, output)
+    else:
+        _remove_atlas_pages(output)
+        _atlas_layout(output).unlink(missing_ok=True)
+        rects = [None] * len(cache.images)
+    with PROFILE.phase("tsx: write", len(cache.images)), \
+            TsxWriter(output, name, len(cache.images), extra) as writer:
+        for i, (image, rect) in enumerate(zip(cache.images, rects)):
+            writer.tile(i+1, image, rect)
 
 
 def add_transparent_image(background, foreground):
-    """https://stackoverflow.com/a/59211216"""
+    """Draw the foreground over the background, in place (it may be a view into a canvas).
+
+    Like https://stackoverflow.com/a/59211216 the colors are weighted by their alpha
+    (color = a_f * c_f + a_b * c_b * (1 - a_f)), but in integers scaled by 255 * 255.
+    That is exact, and only needs two integer copies of the images instead of many floats.
+    """
     bg_h, bg_w, bg_channels = background.shape
     fg_h, fg_w, fg_channels = foreground.shape
 
@@ -134,17 +806,21 @@ def add_transparent_image(background, foreground):
     assert bg_channels == 4
     assert fg_channels == 4
 
-    alpha_background = background[:, :, 3] / 255.0
-    alpha_foreground = foreground[:, :, 3] / 255.0
+    # One plane per channel, so the alpha can be applied to all of them at once.
+    fg = foreground.transpose(2, 0, 1).astype(np.uint32, order="C")
+    bg = background.transpose(2, 0, 1).astype(np.uint32, order="C")
+    transparency_foreground = 255 - fg[3]
 
-    # set adjusted colors
-    for color in range(0, 3):
-        background[:, :, color] = alpha_foreground * foreground[:, :, color] + \
-            alpha_background * background[:, :, color] * (1 - alpha_foreground)
+    # set adjusted alpha: 255 * (1 - (1 - a_f) * (1 - a_b)), rounded down
+    alpha = 255 - (transparency_foreground * (255 - bg[3]) + 254) // 255
 
-    # set adjusted alpha and denormalize back to 0-255
-    background[:, :, 3] = (1 - (1 - alpha_foreground)
-                           * (1 - alpha_background)) * 255
+    # set adjusted colors, rounded down like the float version did
+    bg *= bg[3] * transparency_foreground
+    fg *= fg[3] * 255
+    fg += bg
+    fg //= 255 * 255
+    fg[3] = alpha
+    background[:] = fg.transpose(1, 2, 0)
 
 
 def remove_prefix(string: str, prefix: str):
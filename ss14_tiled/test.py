@@ -1,9 +1,33 @@
 """Some tests."""
+import copy
+import io
+import json
+import os
+import tempfile
+import threading
 import unittest
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import redirect_stderr
+from pathlib import Path
 
+import cv2
+import numpy as np
 from deepdiff import DeepDiff
 
-from .generate.entities import merge_entity
+from . import shared
+from .bench import TreeSize, make_tree
+from .generate import generate
+from .generate.decals import parse_hex, tint
+from .generate.entities import (DIRECTIONS, compose_layers, filter_entities, find_entities,
+                                group_entities, render_entity, select_entities)
+from .generate.inheritance import Inheritance, merge_entity
+from .generate.prototypes import HAS_LIBYAML, Prototypes, SafeLoadIgnoreUnknown, load_yaml
+from .generate.rsi import RSI, RSIS
+from .generate.rules import Rules, apply_filters
+from .shared import (PROFILE, STOP, Cancelled, Image, ImageCache, Options, Profile, SerialExecutor,
+                     Stage, TileCache, add_transparent_image, create_tsx, init_worker, pack_rects,
+                     eprint, read_image, run_stages, strip_png_chunks, write_atlas)
 
 
 class TestMergeEntity(unittest.TestCase):
@@ -117,6 +141,798 @@ class TestMergeEntity(unittest.TestCase):
         diff = DeepDiff(actual, expected, ignore_order=True)
         assert not diff
 
+    def test_shared(self):
+        """The inputs stay the same, and unchanged components are shared, not copied."""
+        parent = {
+            "id": "A",
+            "parent": [],
+            "abstract": True,
+            "components": [
+                {"type": "Sprite", "sprite": "a.rsi", "layers": [{"state": "a"}]},
+                {"type": "Physics"},
+            ]
+        }
+        child = {
+            "id": "B",
+            "parent": ["A"],
+            "components": [{"type": "Sprite", "state": "b"}]
+        }
+        before = copy.deepcopy((child, parent))
+        actual = merge_entity(child, parent)
+        assert not DeepDiff((child, parent), before)
+        assert "abstract" not in actual
+        assert actual["components"][0] == {
+            "type": "Sprite", "sprite": "a.rsi", "layers": [{"state": "a"}], "state": "b"}
+        assert actual["components"][0]["layers"] is parent["components"][0]["layers"]
+        assert actual["components"][1] is parent["components"][1]
+
+    def test_same_type(self):
+        """Components with the same type are all changed, in order, like before."""
+        parent = {
+            "id": "A",
+            "parent": [],
+            "components": [{"type": "x", "a": 1}, {"type": "x", "a": 2}]
+        }
+        child = {
+            "id": "B",
+            "parent": ["A"],
+            "components": [{"type": "x", "b": 1}, {"type": "y", "c": 1}, {"type": "y", "c": 2}]
+        }
+        expected = {
+            "id": "B",
+            "parent": ["A"],
+            "components": [{"type": "x", "a": 1, "b": 1}, {"type": "x", "a": 2, "b": 1},
+                           {"type": "y", "c": 2}]
+        }
+        assert merge_entity(child, parent) == expected
+        assert child["components"][1] == {"type": "y", "c": 1}
+
+
+class TestInheritance(unittest.TestCase):
+    """Tests to see if parents are resolved, and broken ones are reported."""
+
+    def test_resolve(self):
+        """Parents are merged before their children, no matter the order they come in."""
+        inheritance = Inheritance([
+            {"id": "C", "parent": ["B", "A"], "components": [{"type": "c"}]},
+            {"id": "B", "parent": "A", "components": [{"type": "b"}]},
+            {"id": "A", "components": [{"type": "a"}]},
+        ])
+        assert inheritance.order == ["A", "B", "C"]
+        assert not inheritance.missing and not inheritance.cycles
+        resolved = inheritance.resolve("C")
+        assert sorted(x["type"] for x in resolved["components"]) == ["a", "b", "c"]
+        assert sorted(resolved["parent"]) == ["A", "B"]
+        assert inheritance.resolve_all()["C"] is resolved
+
+    def test_broken(self):
+        """Missing parents and cycles don't hang, and everything depending on them is left out."""
+        inheritance = Inheritance([
+            {"id": "A"},
+            {"id": "Orphan", "parent": "Missing"},
+            {"id": "OrphanChild", "parent": ["A", "Orphan"]},
+            {"id": "X", "parent": "Y"},
+            {"id": "Y", "parent": "X"},
+            {"id": "Z", "parent": "Y"},
+        ])
+        assert inheritance.missing == {"Orphan": ["Missing"]}
+        assert inheritance.cycles == [["X", "Y"]]
+        assert inheritance.unresolved == {"Orphan", "OrphanChild", "X", "Y", "Z"}
+        assert list(inheritance.resolve_all()) == ["A"]
+        assert inheritance.resolve("Z") is None
+
+    def test_select(self):
+        """Filtering the headers first ends with the same entities as filtering everything."""
+        sprite = {"type": "Sprite", "sprite": "a.rsi", "state": "a"}
+        inheritance = Inheritance([
+            {"id": "Base", "abstract": True, "components": [sprite]},
+            {"id": "Thing", "parent": "Base", "suffix": "Big"},
+            {"id": "Debug", "parent": "Thing", "suffix": "DEBUG"},
+            {"id": "Hidden", "parent": "Base", "categories": ["HideSpawnMenu"]},
+            {"id": "Timed", "parent": "Thing", "components": [{"type": "TimedDespawn"}]},
+            {"id": "Invisible", "components": [{"type": "Physics"}]},
+            {"id": "Shown", "parent": "Thing", "suffix": "Small", "components": [
+                {"type": "Sprite", "state": "b"}]},
+        ])
+        expected = filter_entities(inheritance.view(lambda x: x).resolve_all())
+        actual = select_entities(inheritance)
+        assert list(actual) == ["Thing", "Shown"]
+        assert not DeepDiff(actual, expected)
+        assert "Hidden" not in inheritance._resolved  # pylint: disable=protected-access
+
+
+class TestRules(unittest.TestCase):
+    """Tests to see if the filters do what the old hardcoded ones did, and can be changed."""
+
+    def test_default(self):
+        """Each entity is removed by the first matching filter, and counted for it."""
+        entities = {
+            "Abstract": {"abstract": True, "components": [{"type": "Sprite"}]},
+            "NoSprite": {"components": [{"type": "Physics"}]},
+            "Debug": {"suffix": "Admeme, DEBUG", "components": [{"type": "Sprite"}]},
+            "Hidden": {"categories": ["HideSpawnMenu"], "components": [{"type": "Sprite"}]},
+            "Spawner": {"components": [{"type": "Sprite"}, {"type": "RandomHumanoidSpawner"}]},
+            "Kept": {"suffix": "Empty", "categories": [], "components": [{"type": "Sprite"}]},
+        }
+        kept, removed = apply_filters(entities, Rules.default().filters)
+        assert list(kept) == ["Kept"]
+        assert removed == {"abstract": 1, "no sprite": 1, "despawns": 0, "debug": 1,
+                           "hidden": 1, "controls and spawners": 1}
+
+    def test_file(self):
+        """A rules file replaces filters by name, and adds new ones."""
+        rules = Rules.from_dict({"filters": [
+            {"name": "debug", "suffixes": "DEBUG"},
+            {"name": "fork", "components": ["Fork"]},
+        ]}, Rules.default())
+        assert [x.name for x in rules.filters][-3:] == ["hidden", "controls and spawners", "fork"]
+        entities = {
+            "Admeme": {"suffix": "Admeme", "components": [{"type": "Sprite"}]},
+            "Fork": {"components": [{"type": "Sprite"}, {"type": "Fork"}]},
+        }
+        assert list(apply_filters(entities, rules.filters)[0]) == ["Admeme"]
+        with self.assertRaises(ValueError):
+            Rules.from_dict({"filters": [{"name": "typo", "component": ["Fork"]}]})
+
+    def test_groups(self):
+        """The first group with the id or an ancestor wins, no matter how far up it is."""
+        inheritance = Inheritance([
+            {"id": "BaseWall"},
+            {"id": "Window"},
+            {"id": "WallSolid", "parent": "BaseWall"},
+            {"id": "WallReinforced", "parent": "WallSolid"},
+            {"id": "WallWindow", "parent": ["WallReinforced", "Window"]},
+            {"id": "Plant"},
+            {"id": "Tree", "parent": "Plant"},
+        ])
+        rules = Rules.from_dict({"groups": [{"name": "Plants", "ids": "Plant"}]}, Rules.default())
+        groups = dict(group_entities(inheritance.resolve_all(), rules.groups))
+        assert list(groups)[-3:] == ["Signs", "Plants", "Other"]
+        assert list(groups["Walls"]) == ["WallSolid", "WallReinforced"]
+        assert list(groups["Windows"]) == ["Window", "WallWindow"]
+        assert list(groups["Plants"]) == ["Plant"]
+        assert list(groups["Other"]) == ["BaseWall", "Tree"]
+
+
+@unittest.skipUnless(HAS_LIBYAML, "PyYAML was built without libyaml")
+class TestLoader(unittest.TestCase):
+    """Tests to see if the libyaml loader behaves like the pure Python one."""
+
+    def test_same_entities(self):
+        """Unknown tags, tabs, anchors and eager booleans."""
+        # pylint: disable=import-outside-toplevel
+        from .generate.prototypes import CSafeLoadIgnoreUnknown
+        text = "\n".join([
+            "- type: entity",
+            "  id: BaseThing",
+            "  abstract: true",
+            "  components:",
+            "  - &sprite",
+            "    type: Sprite",
+            "    sprite: /Textures/Objects/thing.rsi",
+            "    layers:",
+            "    - state: on",
+            "    - state: no",
+            "      visible: false",
+            "  - type: Physics",
+            "    bodyType: !type:Static",
+            "    fixtures: !type:PhysShapeAabb",
+            "      bounds: \"-0.5,-0.5,0.5,0.5\"",
+            "- type: entity",
+            "  parent: [BaseThing]",
+            "  id: Thing",
+            "  suffix: 'DEBUG, 42'",
+            "  components:",
+            "  - *sprite",
+            "  - type: Tag",
+            "    tags:",
+            "\t- Thing",
+            "- null",
+        ])
+        python = load_yaml(text, SafeLoadIgnoreUnknown)
+        libyaml = load_yaml(text, CSafeLoadIgnoreUnknown)
+        assert python[1]["components"][1]["tags"] == ["Thing"]
+        assert python[0]["components"][1]["bodyType"] is None
+        diff = DeepDiff(python, libyaml)
+        assert not diff
+
+
+class TestPrototypeCache(unittest.TestCase):
+    """Tests to see if only changed prototype files are parsed again."""
+
+    def test_hits(self):
+        """Unchanged files come from the cache, broken ones too, but not those with dates."""
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            prototypes = root / "Resources" / "Prototypes"
+            prototypes.mkdir(parents=True)
+            (prototypes / "a.yml").write_text("- type: tile\n  id: A\n", "UTF-8")
+            (prototypes / "b.yml").write_text("- type: tile\n  id: B\n", "UTF-8")
+            (prototypes / "broken.yml").write_text("- type: [tile\n", "UTF-8")
+            # Dates can't be cached, the file is parsed every time.
+            (prototypes / "date.yml").write_text("- type: date\n  id: 2020-01-01\n", "UTF-8")
+            cache = root / "prototypes.marshal"
+
+            def load() -> tuple[list[str], dict]:
+                PROFILE.clear(True)
+                try:
+                    with redirect_stderr(io.StringIO()):
+                        tiles = Prototypes.from_root(root, cache).of_type("tile")
+                    return [x["id"] for x in tiles], PROFILE.report()
+                finally:
+                    PROFILE.clear(False)
+
+            ids, report = load()
+            assert ids == ["A", "B"]
+            assert report["phases"]["prototypes: parse"]["count"] == 4
+            written = cache.stat().st_mtime_ns
+
+            ids, report = load()
+            assert ids == ["A", "B"]
+            assert report["counts"]["prototypes: cache hits"] == 3
+            assert report["phases"]["prototypes: parse"]["count"] == 1
+            assert cache.stat().st_mtime_ns == written
+
+            (prototypes / "b.yml").write_text("- type: tile\n  id: C\n", "UTF-8")
+            os.utime(prototypes / "b.yml", ns=(0, 0))
+            ids, report = load()
+            assert ids == ["A", "C"]
+            assert report["counts"]["prototypes: cache hits"] == 2
+            assert report["phases"]["prototypes: parse"]["count"] == 2
+
+
+class TestRSI(unittest.TestCase):
+    """Tests to see if RSI states are found."""
+
+    def test_states(self):
+        """Plain names, directions, delays and YAML's eager booleans."""
+        rsi = RSI.from_dict(Path("thing.rsi"), {
+            "size": {"x": 32, "y": 48},
+            "states": [
+                {"name": "base", "directions": 4},
+                {"name": "On", "delays": [[0.1, 0.2, 0.3]]},
+                {"name": "off"},
+                {"name": "base", "directions": 8},
+            ]
+        })
+        assert (rsi.width, rsi.height) == (32, 48)
+        assert rsi.state("base").directions == 4
+        assert rsi.state("On").frames == 3
+        assert rsi.state(True).name == "On"
+        assert rsi.state(False).name == "off"
+        assert rsi.state("missing") is None
+
+
+class TestImageCache(unittest.TestCase):
+    """Tests to see if decoded images are shared and evicted."""
+
+    def test_lru(self):
+        """Two of three images fit, the least recently used one goes."""
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [Path(tmp) / f"{i}.png" for i in range(3)]
+            for i, path in enumerate(paths):
+                cv2.imwrite(str(path), np.full((4, 4, 3), i, np.uint8))
+
+            cache = ImageCache(2 * 4 * 4 * 4)
+            first = cache.read(paths[0])
+            assert first.shape == (4, 4, 4)
+            assert (first[:, :, 3] == 255).all()
+            assert not first.flags.writeable
+            cache.read(paths[1])
+            assert cache.read(paths[0]) is first
+            cache.read(paths[2])  # drops 1, not 0
+            assert cache.read(paths[0]) is first
+            cache.read(paths[1])
+            assert (cache.hits.value, cache.misses.value) == (2, 4)
+            assert cache.read(Path(tmp) / "missing.png") is None
+
+
+class TestColorProfile(unittest.TestCase):
+    """Tests to see if color profiles are dropped without touching the file."""
+
+    def test_strip_iccp(self):
+        """An iCCP chunk between IHDR and IDAT goes, everything else stays."""
+        pixels = np.arange(4 * 4 * 4, dtype=np.uint8).reshape((4, 4, 4))
+        clean = cv2.imencode(".png", pixels)[1].tobytes()
+        ihdr_end = 8 + 12 + 13
+        iccp = (3).to_bytes(4, "big") + b"iCCP" + b"abc" + b"\0\0\0\0"
+        dirty = clean[:ihdr_end] + iccp + clean[ihdr_end:]
+
+        assert strip_png_chunks(dirty, (b"iCCP",)) == clean
+        assert strip_png_chunks(clean, (b"iCCP",)) is clean
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "dirty.png"
+            path.write_bytes(dirty)
+            assert (read_image(path) == pixels).all()
+            assert path.read_bytes() == dirty
+
+
+class TestTint(unittest.TestCase):
+    """Tests to see if the batched decal colors match the old float version."""
+
+    def test_all_values(self):
+        """Every pixel value times every color value, rounded like before."""
+        img = np.broadcast_to(np.arange(256, dtype=np.uint8)[:, None, None], (256, 1, 4))
+        colors = [(x, 255 - x, x // 2, 255) for x in range(256)]
+        expected = np.stack([np.round(img * (np.array(c)[[2, 1, 0, 3]] / 255))
+                             for c in colors])
+        assert (tint(img, colors) == expected).all()
+
+    def test_colors(self):
+        """Each color gets its own image, in BGRA order."""
+        img = np.full((2, 3, 4), 255, np.uint8)
+        variants = tint(img, [parse_hex("#FFF"), parse_hex("#12345678")])
+        assert variants.shape == (2, 2, 3, 4)
+        assert (variants[0] == 255).all()
+        assert (variants[1] == (0x56, 0x34, 0x12, 0x78)).all()
+
+
+def add_transparent_image_float(background, foreground):
+    """The old float version of `add_transparent_image`, to compare against."""
+    alpha_background = background[:, :, 3] / 255.0
+    alpha_foreground = foreground[:, :, 3] / 255.0
+
+    for color in range(0, 3):
+        background[:, :, color] = alpha_foreground * foreground[:, :, color] + \
+            alpha_background * background[:, :, color] * (1 - alpha_foreground)
+
+    background[:, :, 3] = (1 - (1 - alpha_foreground)
+                           * (1 - alpha_background)) * 255
+
+
+class TestCompositing(unittest.TestCase):
+    """Tests to see if the integer compositing matches the old float version."""
+
+    def test_golden(self):
+        """Random layers, with plenty of fully (in)visible pixels, differ by 1 at most."""
+        rng = np.random.default_rng(14)
+        for shape in ((32, 32, 4), (33, 17, 4), (1, 1, 4)):
+            background = rng.integers(0, 256, shape, np.uint8)
+            foreground = rng.integers(0, 256, shape, np.uint8)
+            background[rng.random(shape[:2]) < 0.3, 3] = 0
+            foreground[rng.random(shape[:2]) < 0.3, 3] = 255
+            foreground[rng.random(shape[:2]) < 0.3, 3] = 0
+
+            expected = background.copy()
+            add_transparent_image_float(expected, foreground)
+            actual = background.copy()
+            add_transparent_image(actual, foreground)
+            assert np.abs(actual.astype(int) - expected).max() <= 1
+
+    def test_view(self):
+        """Drawing into a part of a canvas leaves the rest alone."""
+        canvas = np.zeros((4, 4, 4), np.uint8)
+        layer = np.full((2, 2, 4), 255, np.uint8)
+        add_transparent_image(canvas[1:3, 1:3], layer)
+        assert (canvas[1:3, 1:3] == 255).all()
+        assert canvas.sum() == 4 * 4 * 255
+
+
+class TestComposeLayers(unittest.TestCase):
+    """Tests to see if one canvas gives the same image as padding it for every layer."""
+
+    @staticmethod
+    def compose_padded(layer_images):
+        """How the layers were drawn before, growing the canvas with copyMakeBorder."""
+        img = layer_images[0].copy()
+        for layer_image in layer_images[1:]:
+            e_height, e_width = img.shape[:2]
+            height, width = layer_image.shape[:2]
+            m_height = max(e_height, height)
+            m_width = max(e_width, width)
+            top, left = (m_height - e_height) // 2, (m_width - e_width) // 2
+            img = cv2.copyMakeBorder(img, top, m_height - e_height - top, left,
+                                     m_width - e_width - left, cv2.BORDER_CONSTANT, value=0)
+            top, left = (m_height - height) // 2, (m_width - width) // 2
+            layer_image = cv2.copyMakeBorder(layer_image, top, m_height - height - top, left,
+                                             m_width - width - left, cv2.BORDER_CONSTANT,
+                                             value=0)
+            add_transparent_image(img, layer_image)
+        return img
+
+    def test_sizes(self):
+        """Layers of all kinds of (odd) sizes."""
+        rng = np.random.default_rng(18)
+        for _ in range(50):
+            layer_images = [rng.integers(0, 256, (rng.integers(1, 9), rng.integers(1, 9), 4),
+                                         np.uint8) for _ in range(rng.integers(1, 5))]
+            expected = self.compose_padded(layer_images)
+            assert (compose_layers(layer_images) == expected).all()
+
+
+class TestRenderEntity(unittest.TestCase):
+    """Tests to see if rendering every direction in one pass gives the images it did before."""
+
+    @staticmethod
+    def render_nested(entity: dict, resources_dir: Path) -> dict[str, np.ndarray]:
+        """How the layers were picked before, going over all of them again for every direction.
+
+        The first direction only knows the most directions of the layers up to each one.
+        """
+        layers = entity["components"][0]["layers"]
+        diagonal = "diagonal" in entity.get("suffix", "")
+        max_directions = 4 if diagonal else 1
+        images = {}
+        for d, direction in enumerate(DIRECTIONS):
+            if d >= max_directions:
+                break
+            layer_images = []
+            for layer in layers:
+                rsi = RSIS.get(resources_dir / "Textures" / layer["sprite"])
+                state = rsi.state(layer["state"])
+                max_directions = max(max_directions, state.directions)
+                if state.directions == 1:
+                    index = 0
+                elif state.directions == max_directions:
+                    index = state.frames * d
+                else:
+                    continue
+                layer_image = cv2.imread(str(rsi.path / f"{state.name}.png"),
+                                         cv2.IMREAD_UNCHANGED)
+                tiles_x = layer_image.shape[1] // rsi.width
+                y, x = (index // tiles_x) * rsi.height, (index % tiles_x) * rsi.width
+                layer_images.append(layer_image[y:y+rsi.height, x:x+rsi.width])
+            img = compose_layers(layer_images)
+            if diagonal and d:
+                img = cv2.rotate(img, (None, cv2.ROTATE_180, cv2.ROTATE_90_COUNTERCLOCKWISE,
+                                       cv2.ROTATE_90_CLOCKWISE)[d])
+            images[direction] = img
+        return images
+
+    def test_directions(self):
+        """Layers with 1, 4 and 8 directions mixed in different orders, also diagonal."""
+        rng = np.random.default_rng(19)
+        with tempfile.TemporaryDirectory() as tmp:
+            resources_dir = Path(tmp)
+            for name, (width, height) in (("a.rsi", (32, 32)), ("b.rsi", (48, 40))):
+                rsi_dir = resources_dir / "Textures" / name
+                rsi_dir.mkdir(parents=True)
+                states = (("one", 1, 1), ("four", 4, 2), ("eight", 8, 1))
+                for (state, directions, frames) in states:
+                    img = rng.integers(0, 256, (height, width * directions * frames, 4),
+                                       np.uint8)
+                    cv2.imwrite(str(rsi_dir / f"{state}.png"), img)
+                (rsi_dir / "meta.json").write_text(json.dumps({
+                    "size": {"x": width, "y": height},
+                    "states": [{"name": x, "directions": d, "delays": [[0.1] * f] * d}
+                               for (x, d, f) in states]}), "UTF-8")
+            RSIS.clear()
+
+            stacks = [("one", "four", "eight"), ("eight", "four", "one"), ("four", "eight"),
+                      ("one", "eight", "four"), ("one",), ("four", "one")]
+            out = resources_dir / "out"
+            out.mkdir()
+            # Diagonal ones can only have four directions.
+            diagonal = [x for x in stacks if "eight" not in x]
+            for i, stack in enumerate(stacks + diagonal):
+                entity = {"id": f"E{i}", "components": [{"type": "Sprite", "layers": [
+                    {"sprite": ("a.rsi", "b.rsi")[j % 2], "state": x}
+                    for j, x in enumerate(stack)]}]}
+                if i >= len(stacks):
+                    entity["suffix"] = "diagonal"
+                expected = self.render_nested(entity, resources_dir)
+                outputs = render_entity(entity, resources_dir, out)
+                assert [x for (x, _) in outputs] == [f"E{i}_{x}" for x in expected]
+                for direction, img in expected.items():
+                    written = cv2.imread(str(out / f"E{i}_{direction}.png"), cv2.IMREAD_UNCHANGED)
+                    assert (written == img).all(), (stack, direction)
+            RSIS.clear()
+
+
+class TestAtlas(unittest.TestCase):
+    """Tests to see if atlases hold every image without overlaps."""
+
+    def test_pack(self):
+        """Rectangles stay on their page and don't overlap, big ones get their own page."""
+        rng = np.random.default_rng(20)
+        sizes = [tuple(int(x) for x in rng.integers(1, 40, 2)) for _ in range(200)] + [(70, 90)]
+        positions = pack_rects(sizes, 64)
+        assert positions[-1] == (0, 0, 0)
+        assert [x[0] for x in positions].count(0) == 1
+        pages = {}
+        for (w, h), (page, x, y) in zip(sizes, positions):
+            canvas = pages.setdefault(page, np.zeros((100, 100), int))
+            canvas[y:y+h, x:x+w] += 1
+            if (w, h) != (70, 90):
+                assert x + w <= 64 and y + h <= 64
+        assert all(x.max() == 1 for x in pages.values())
+        assert sum(x.sum() for x in pages.values()) == sum(w * h for (w, h) in sizes)
+
+    def test_pages(self):
+        """Pages are kept while no tile changes, and those no longer used are removed."""
+        with tempfile.TemporaryDirectory() as tmp:
+            base = Path(tmp)
+            output = base / "test.tsx"
+            cache = TileCache(base / ".data" / "test.jsonl")
+            (base / ".data").mkdir()
+            for i, size in enumerate([(32, 32), (64, 32), (32, 96)]):
+                cv2.imwrite(str(base / f"{i}.png"), np.full((size[1], size[0], 4), i, np.uint8))
+                cache.update(str(i), Image(f"./{i}.png", str(size[0]), str(size[1])), str(i))
+            # Left out of the pages, also when they are kept.
+            (base / "3.png").write_bytes(b"broken")
+            cache.update("3", Image("./3.png", "32", "32"), "3")
+            cache.save()
+            (base / ".atlas").mkdir()
+            stale = base / ".atlas" / "test_1.png"
+            stale.write_bytes(b"old")
+            with redirect_stderr(io.StringIO()):
+                rects = write_atlas(cache, output)
+            page = base / ".atlas" / "test_0.png"
+            assert rects[3] is None
+            assert {x[0] for x in rects[:3]} == {"./.atlas/test_0.png"}
+            assert read_image(page)[rects[2][4], rects[2][3], 0] == 2
+            assert not stale.exists()
+
+            page.write_bytes(b"kept")
+            cache = TileCache.load(cache.path)
+            assert write_atlas(cache, output) == rects
+            assert page.read_bytes() == b"kept"
+
+            cache.update("1", Image("./1.png", "64", "32"), "changed")
+            with redirect_stderr(io.StringIO()):
+                assert write_atlas(cache, output) == rects
+            assert read_image(page) is not None
+
+
+class TestStages(unittest.TestCase):
+    """Tests to see if the jobs of all stages run as one stream."""
+
+    def test_stream(self):
+        """Results are collected in order, and every stage is finished once."""
+        events = []
+
+        def stage(name: str, jobs: list) -> Stage:
+            return Stage(abs, jobs, lambda i, x: events.append((name, i, x)),
+                         lambda: events.append((name, "finish")))
+
+        progress = []
+        with ThreadPoolExecutor(2) as executor:
+            run_stages([stage("a", [-1, 2, -3]), stage("b", []), stage("c", [4])], executor,
+                       Options(jobs=1), lambda done, total: progress.append((done, total)),
+                       chunksize=2)
+        assert events == [("a", 0, 1), ("a", 1, 2), ("a", 2, 3), ("a", "finish"),
+                          ("b", "finish"), ("c", 0, 4), ("c", "finish")]
+        assert progress == [(2, 4), (3, 4), (4, 4)]
+
+    def test_warnings(self):
+        """Warnings of worker processes end up in the output of this one."""
+        output = io.StringIO()
+        with ProcessPoolExecutor(1) as executor, redirect_stderr(output):
+            run_stages([Stage(eprint, ["one", "two"], lambda i, x: None, lambda: None)],
+                       executor, Options(jobs=1))
+        assert output.getvalue() == "one\ntwo\n"
+
+    def test_cancel(self):
+        """Nothing is finished after a cancel, and the progress counts items."""
+        events = []
+        progress = []
+        cancel = threading.Event()
+
+        def collect(i: int, result):
+            events.append((i, result))
+            if i == 1:
+                cancel.set()
+
+        stages = [Stage(abs, [-1, 2, -3, 4], collect, lambda: events.append("finish"),
+                        items=[1, 2, 3, 4]),
+                  Stage(abs, [5], collect, lambda: events.append("finish"))]
+        try:
+            with self.assertRaises(Cancelled):
+                run_stages(stages, SerialExecutor(), Options(jobs=1),
+                           lambda done, total: progress.append((done, total)),
+                           chunksize=2, cancel=cancel)
+            assert events == [(0, 1), (1, 2)]
+            assert progress == [(3, 11)]
+            assert STOP.is_set()
+
+            # The next run isn't stopped by it.
+            events.clear()
+            run_stages(stages[1:], SerialExecutor(), Options(jobs=1))
+            assert events == [(0, 5), "finish"]
+
+            with tempfile.TemporaryDirectory() as tmp, self.assertRaises(Cancelled):
+                make_tree(Path(tmp), TreeSize(entities=1, rsis=1, tiles=1, decals=1))
+                Prototypes.from_root(Path(tmp), cancel=cancel)
+        finally:
+            init_worker(Options())
+
+
+class TestTileCache(unittest.TestCase):
+    """Tests to see if tile-set caches keep their ids and survive a restart."""
+
+    def test_log(self):
+        """Changes are appended, and a reload has the same ids in the same order."""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / ".data" / "test.jsonl"
+            cache = TileCache.load(path)
+            cache.update("a", Image("./a.png", "32", "32"), "1")
+            cache.update("b", Image("./b.png", "32", "64"), "2")
+            cache.save()
+            cache.update("a", Image("./a.png", "64", "32"), "3")
+            cache.save()
+            cache.save()
+            assert len(path.read_text("UTF-8").splitlines()) == 3
+            with path.open("a", encoding="UTF-8") as f:
+                f.write('["c", "./c.p')
+
+            cache = TileCache.load(path)
+            assert cache.ids == ["a", "b"]
+            assert cache.images[0].width == "64"
+            assert cache.fingerprints == {"a": "3", "b": "2"}
+
+            # The broken line isn't appended to, the new tiles keep their ids.
+            cache.update("c", Image("./c.png", "32", "32"), "4")
+            cache.update("d", Image("./d.png", "32", "32"), "5")
+            cache.save()
+            assert TileCache.load(path).ids == ["a", "b", "c", "d"]
+
+            # Updates without changes aren't written.
+            cache.update("a", Image("./a.png", "64", "32"), "3")
+            cache.update("b", Image("./b.png", "32", "64"))
+            cache.save()
+            assert len(path.read_text("UTF-8").splitlines()) == 4
+
+    def test_migrate(self):
+        """The caches of older versions are taken over."""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "test.jsonl"
+            path.with_suffix(".json").write_text(
+                '{"ids": ["b", "a"], "images": [{"source": "./b.png", "width": "32", '
+                '"height": "32"}, {"source": "./a.png", "width": "32", "height": "32"}], '
+                '"fingerprints": {"a": "1"}}', "UTF-8")
+            cache = TileCache.load(path)
+            assert cache.ids == ["b", "a"]
+            assert cache.fingerprints == {"a": "1"}
+            cache.save()
+            assert not path.with_suffix(".json").exists()
+            assert TileCache.load(path).ids == ["b", "a"]
+
+        # Older versions repeated tiles, they keep their place and so do the tiles after them.
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "test.jsonl"
+            images = [{"source": f"./{x}.png", "width": "32", "height": "32"} for x in "abac"]
+            path.with_suffix(".json").write_text(json.dumps(
+                {"ids": ["a", "b", "a", "c"], "images": images}), "UTF-8")
+            cache = TileCache.load(path)
+            assert cache.ids == ["a", "b", "a", "c"]
+            assert [x.source for x in cache.images] == ["./a.png", "./b.png", "./a.png", "./c.png"]
+            cache.save()
+
+            cache = TileCache.load(path)
+            assert cache.ids == ["a", "b", None, "c"]
+            cache.update("a", Image("./a2.png", "32", "32"), "1")
+            cache.update("d", Image("./d.png", "32", "32"), "2")
+            cache.save()
+            cache = TileCache.load(path)
+            assert cache.ids == ["a", "b", None, "c", "d"]
+            assert [x.source for x in cache.images] == \
+                ["./a2.png", "./b.png", "./a.png", "./c.png", "./d.png"]
+
+
+class TestTsx(unittest.TestCase):
+    """Tests to see if tile-set files are valid, and only written when they change."""
+
+    def test_write(self):
+        """Every tile ends up in the file, odd characters included."""
+        with tempfile.TemporaryDirectory() as tmp:
+            output = Path(tmp) / "test.tsx"
+            cache = TileCache(Path(tmp) / "test.jsonl")
+            cache.update("a", Image("./a&<\"b>.png", "32", "64"))
+            cache.update("b", Image("./b.png", "48", "32"))
+            create_tsx(cache, "Test \"1\"\n", output, {"color": "#FFF'"})
+            root = ET.parse(output).getroot()
+            assert root.attrib == {"name": "Test \"1\"\n", "tilecount": "2", "columns": "0"}
+            assert root.find("properties/property").attrib == {"name": "color", "value": "#FFF'"}
+            assert [(x.get("id"), x.find("image").attrib) for x in root.iter("tile")] == [
+                ("1", {"source": "./a&<\"b>.png", "width": "32", "height": "64"}),
+                ("2", {"source": "./b.png", "width": "48", "height": "32"})]
+
+            mtime = output.stat().st_mtime_ns
+            create_tsx(cache, "Test \"1\"\n", output, {"color": "#FFF'"})
+            assert output.stat().st_mtime_ns == mtime
+            assert [x.name for x in Path(tmp).iterdir()] == ["test.tsx"]
+
+
+class TestProfile(unittest.TestCase):
+    """Tests to see if profiles add up, also over processes."""
+
+    def test_merge(self):
+        """What a worker measured ends up in the profile of the main process."""
+        main = Profile()
+        with main.phase("a"):
+            pass
+        assert not main.phases and main.take() is None
+
+        main.clear(True)
+        worker = Profile()
+        worker.clear(True)
+        with main.phase("a", 2):
+            pass
+        with worker.phase("a", 3):
+            pass
+        worker.count("hits", 4)
+        main.merge(worker.take())
+        assert not worker.phases and not worker.counts
+        report = main.report()
+        assert report["phases"]["a"]["count"] == 5
+        assert report["counts"] == {"hits": 4}
+
+
+class TestBench(unittest.TestCase):
+    """Tests to see if the synthetic repository of the benchmarks is usable."""
+
+    def test_tree(self):
+        """Every entity resolves, and generate() makes every tile-set from it."""
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp) / "ss14"
+            make_tree(root, TreeSize(entities=40, depth=3, rsis=3, tiles=3, decals=2, palettes=1))
+            inheritance = find_entities(root)
+            assert not inheritance.unresolved
+            # One chain of two abstract bases per 50 entities.
+            assert len(inheritance.resolve_all()) == 40 + 2
+
+            out = Path(tmp) / "out"
+            generate(root, output_path=out, options=Options(executor="serial"))
+            assert ET.parse(out / "tiles.tsx").getroot().get("tilecount") == "3"
+            assert len(list(out.glob("decals*.tsx"))) == 1 + 5
+            tiles = ET.parse(out / "entities_Other.tsx").getroot().findall("tile")
+            # Two are filtered out, the others have 1, 1, 4, 4 or 8 directions.
+            assert len({x.find("image").get("source").split("_")[0] for x in tiles}) == 38
+
+
+class TestIncremental(unittest.TestCase):
+    """Tests to see if incremental runs only re-create the images whose inputs changed."""
+
+    def test_changes(self):
+        """Nothing is rewritten without changes, and only the dependent images after one."""
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp) / "ss14"
+            make_tree(root, TreeSize(entities=40, depth=3, rsis=4, tiles=3, decals=2, palettes=2))
+            out = Path(tmp) / "out"
+            options = Options(executor="serial", incremental=True)
+            generate(root, output_path=out, options=options)
+            images = sorted((out / ".images").glob("**/*.png"))
+
+            def rewritten() -> set[str]:
+                """Run again, and return the names of the images that were written."""
+                for image in images:
+                    os.utime(image, ns=(0, 0))
+                generate(root, output_path=out, options=options)
+                return {f"{x.parent.name}/{x.name}" for x in images if x.stat().st_mtime_ns}
+
+            def touch(path: Path):
+                stat = path.stat()
+                os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+            assert not rewritten()
+
+            textures = root / "Resources" / "Textures"
+            touch(textures / "Bench" / "rsi_0.rsi" / "dir4.png")
+            # Every entity with that RSI, but the filtered BenchEntity24.
+            users = {f"BenchEntity{i}" for i in range(0, 40, 4)} - {"BenchEntity24"}
+            expected = {f"entities/{x.name}" for x in images
+                        if x.parent.name == "entities" and x.name.rsplit("_", 1)[0] in users}
+            assert len(expected) >= len(users)
+            assert rewritten() == expected
+
+            touch(textures / "Tiles" / "bench_1.png")
+            assert rewritten() == {"tiles/BenchFloor1.png"}
+
+            palettes = root / "Resources" / "Prototypes" / "Palettes" / "bench_0.yml"
+            text = palettes.read_text("UTF-8")
+            color = text.split("color0: '")[1][:7]
+            palettes.write_text(text.replace(color, "#123456", 1), "UTF-8")
+            assert rewritten() == {"decals_Bench0_color0/BenchDecal0.png",
+                                   "decals_Bench0_color0/BenchDecal1.png"}
+
+            # Other rendering code, so every image again.
+            version = shared.RENDER_VERSION
+            shared.RENDER_VERSION += 1
+            try:
+                assert rewritten() == {f"{x.parent.name}/{x.name}" for x in images}
+            finally:
+                shared.RENDER_VERSION = version
+
 
 if __name__ == "__main__":
     unittest.main()